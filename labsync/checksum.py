@@ -2,6 +2,16 @@ import os
 import hashlib
 import base64
 import random
+import mmap
+import re
+import queue
+import tempfile
+import threading
+import time
+import configparser
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
 import numpy as np
 import logging
 import pkg_resources  # part of setuptools
@@ -15,7 +25,237 @@ logger = logging.getLogger("Labdata_cleanup.checksum")
 
 #print (hashlib.algorithms_available)
 
-def chunk_md5(fname, blocksize=4096):
+DEFAULT_BLOCKSIZE = 1048576
+"""
+Block size in bytes used when none is configured or autotuned.
+"""
+
+BLOCKSIZES = (65536, 262144, 1048576, 4194304)
+"""
+Block sizes that `autotune_blocksize` chooses from.
+"""
+
+TUNING_FILE = 'labsync_tuning.ini'
+"""
+File in which the autotuned block size for this machine is recorded.
+"""
+
+SIDECARS = OrderedDict([('.sha256', 'SHA256'), ('.md5', 'MD5')])
+"""
+Extensions of sidecar checksum files (sha256sum/md5sum output) and their algoIDs.
+"""
+
+HashType = namedtuple('HashType', ['algoID', 'constructor', 'encode', 'decode'])
+"""
+A vault index hashtype: the algoID used within this package, a hashlib constructor,
+and functions that turn a raw digest into the index file encoding and back.
+"""
+
+def _b64encode(raw):
+    return base64.b64encode(raw).decode('utf-8')
+
+def _b64decode(encoded):
+    return base64.b64decode(encoded, validate=True)
+
+def _hexencode(raw):
+    return raw.hex()
+
+def _hexdecode(encoded):
+    return bytes.fromhex(encoded)
+
+HASHTYPES = OrderedDict([('sha2', HashType('SHA256', hashlib.sha256, _b64encode, _b64decode)),
+                         ('md5', HashType('MD5', hashlib.md5, _hexencode, _hexdecode))])
+"""
+Registered vault index hashtypes (see Yoda_indexfile_format.txt), in order of
+preference. Use `register_hashtype` when iRODS starts using a new one.
+"""
+
+PRIMARY = 'sha2'
+"""
+The hashtype that is computed for every local file; uploads are recorded with it.
+"""
+
+def register_hashtype(hashtype, algoID, constructor, encode=_hexencode, decode=_hexdecode):
+    """
+    Register a hashtype, so index entries of that type are matched with local files.
+    
+    **Parameters**  
+    ---------------
+    hashtype: str  
+        *The hashtype as it appears in the index file, e.g. 'sha512'.*  
+    algoID: str  
+        *Name used within this package, e.g. 'SHA512'.*  
+    constructor: callable  
+        *Returns a new hashlib-like object, e.g. hashlib.sha512.*  
+    encode: callable  
+        *Raw digest bytes to the index file string, hex by default.*  
+    decode: callable  
+        *Index file string to raw digest bytes, hex by default.*  
+    
+    **Notes**  
+    ---------
+    The hashtype also names a column of the digest catalog ('digest_<hashtype>'),
+    so only lowercase letters, digits and underscores are allowed.
+    """
+    if not re.match(r'^[a-z0-9_]+$', hashtype):
+        logger.critical("Invalid hashtype name: " + str(hashtype))
+        raise ValueError("Invalid hashtype name: " + str(hashtype))
+    HASHTYPES[hashtype] = HashType(algoID.upper(), constructor, encode, decode)
+
+def digest_width():
+    """
+    Length of the longest digest string of the registered hashtypes, e.g. 44 for the
+    base64 encoded SHA256 and 128 for a hex encoded SHA512 digest.
+    """
+    return max(len(spec.encode(spec.constructor().digest())) for spec in HASHTYPES.values())
+
+def hashtype_of(algoID):
+    """
+    The registered hashtype for an algoID (or for a hashtype name).
+    
+    **Parameters**  
+    ---------------
+    algoID: str  
+        *E.g. 'SHA256', 'MD5' or 'sha2'.*  
+    
+    **Returns**  
+    ------------
+    str  
+        *The hashtype, e.g. 'sha2'.*  
+    """
+    if algoID in HASHTYPES:
+        return algoID
+    for hashtype, spec in HASHTYPES.items():
+        if spec.algoID == algoID.upper():
+            return hashtype
+    logger.critical("A non-implemented or wrong algoID was given: " + str(algoID))
+    raise ValueError("A non-implemented or wrong algoID was given: " + str(algoID))
+
+def by_hashtype(digests):
+    """
+    Re-key a dict as returned by `chunk_multi` from algoID to hashtype.
+    """
+    return dict((hashtype_of(algoID), digest) for algoID, digest in digests.items())
+
+def _feed_readinto(f, updates, blocksize):
+    """
+    Read into one preallocated buffer and hand memoryview slices to the hashes.
+    """
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        chunk = view[:n]
+        for update in updates:
+            update(chunk)
+
+def _feed_mmap(f, updates, blocksize):
+    """
+    Hash straight from a read-only memory map of the file.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return # an empty file cannot be mapped
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for offset in range(0, len(mm), blocksize):
+                chunk = view[offset:offset + blocksize]
+                for update in updates:
+                    update(chunk)
+                chunk.release()
+        finally:
+            view.release()
+
+def _feed_double(f, updates, blocksize):
+    """
+    Double buffering: a reader thread fills one buffer while the other is digested.
+    
+    Both readinto() and hashlib release the GIL, so reading and digesting overlap.
+    """
+    buffers = [bytearray(blocksize), bytearray(blocksize)]
+    free = queue.Queue()
+    full = queue.Queue()
+    free.put(0)
+    free.put(1)
+    def reader():
+        try:
+            while True:
+                i = free.get()
+                if i is None:
+                    return
+                n = f.readinto(buffers[i])
+                full.put((i, n))
+                if not n:
+                    return
+        except Exception as e:
+            full.put((None, e))
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            i, n = full.get()
+            if i is None:
+                raise n
+            if not n:
+                break
+            chunk = memoryview(buffers[i])[:n]
+            for update in updates:
+                update(chunk)
+            chunk.release()
+            free.put(i)
+    finally:
+        free.put(None)
+        thread.join()
+
+def feed_file(fname, hashes, blocksize=DEFAULT_BLOCKSIZE, method='auto'):
+    """
+    Feed the contents of a file to one or more hashlib objects without a bytes copy
+    per chunk.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *File name.*  
+    hashes: list  
+        *hashlib objects to update.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+    method: str  
+        *'readinto' (one reused buffer), 'double' (two buffers, reading overlaps  
+        digesting), 'mmap' (memory mapped) or 'auto': double buffering for files
+        larger than four blocks, else readinto.*
+    """
+    updates = [myhash.update for myhash in hashes]
+    with open(fname, "rb", buffering=0) as f:
+        if method == 'auto':
+            if os.fstat(f.fileno()).st_size > 4 * blocksize:
+                method = 'double'
+            else:
+                method = 'readinto'
+        if method == 'mmap':
+            _feed_mmap(f, updates, blocksize)
+        elif method == 'double':
+            _feed_double(f, updates, blocksize)
+        elif method == 'readinto':
+            _feed_readinto(f, updates, blocksize)
+        else:
+            logger.critical("Unknown hashing method: " + str(method))
+            raise ValueError("Unknown hashing method: " + str(method))
+
+def _digest_one(fname, constructor, blocksize, method):
+    """
+    Hash a file for a single algorithm, using hashlib.file_digest when available.
+    """
+    if method == 'auto' and hasattr(hashlib, 'file_digest'):
+        with open(fname, "rb") as f:
+            return hashlib.file_digest(f, constructor)
+    myhash = constructor()
+    feed_file(fname, [myhash], blocksize, method)
+    return myhash
+
+def chunk_md5(fname, blocksize=DEFAULT_BLOCKSIZE):
     """
     Checksums a file in chunks of `blocksize` bytes.
     
@@ -31,13 +271,10 @@ def chunk_md5(fname, blocksize=4096):
     str   
         *An MD5 hash string for the file.*
     """
-    myhash = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(blocksize), b""):
-            myhash.update(chunk)
+    myhash = _digest_one(fname, hashlib.md5, blocksize, 'auto')
     return myhash.hexdigest()
 
-def chunk_sha256(fname, blocksize=4096):
+def chunk_sha256(fname, blocksize=DEFAULT_BLOCKSIZE):
     """
     Checksums a file in chunks of `blocksize` bytes.
     
@@ -53,13 +290,318 @@ def chunk_sha256(fname, blocksize=4096):
     str   
         *An SHA256 hash string for the file.*
     """
-    myhash = hashlib.sha256()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(blocksize), b""):
-            myhash.update(chunk)
+    myhash = _digest_one(fname, hashlib.sha256, blocksize, 'auto')
     return base64.b64encode(myhash.digest())
 
-def make_hash_string(fname, algoID):
+def chunk_multi(fname, algoIDs=None, blocksize=DEFAULT_BLOCKSIZE, method='auto'):
+    """
+    Checksums a file in chunks of `blocksize` bytes for several algorithms at once.
+    
+    Every chunk is fed to all requested hash objects, so the file is read only once
+    no matter how many digests are needed.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *File name.*  
+    algoIDs: tuple  
+        *Hashing algorithms of registered hashtypes, e.g. ('SHA256', 'MD5'); None  
+        for all registered hashtypes.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+    method: str  
+        *Read strategy, see `feed_file`.*  
+    
+    **Returns**  
+    ------------
+    dict  
+        *algoID as key, the hash string as value, encoded like in the Yoda index file  
+        (base64 for SHA256, hex for MD5).*
+    """
+    if algoIDs is None:
+        algoIDs = [spec.algoID for spec in HASHTYPES.values()]
+    hashes = OrderedDict()
+    for algoID in algoIDs:
+        spec = HASHTYPES[hashtype_of(algoID)]
+        hashes[spec.algoID] = spec.constructor()
+    if len(hashes) == 1:
+        algoID = list(hashes.keys())[0]
+        hashes[algoID] = _digest_one(fname, hashes[algoID].copy, blocksize, method)
+    else:
+        feed_file(fname, list(hashes.values()), blocksize, method)
+    out = {}
+    for algoID, myhash in hashes.items():
+        out[algoID] = HASHTYPES[hashtype_of(algoID)].encode(myhash.digest())
+    return out
+
+def default_workers():
+    """
+    Number of hashing threads to use when none is configured.
+    
+    **Returns**  
+    ------------
+    int  
+        *The number of CPUs, but at least 1 and at most 8 (beyond that the disk is  
+        the bottleneck on lab workstations).*
+    """
+    return max(1, min(8, os.cpu_count() or 1))
+
+def _hash_batch(batch, algoIDs, blocksize, method):
+    """
+    Hash a batch of files in one thread pool task, None for unreadable files.
+    """
+    out = []
+    for fname, fp in batch:
+        try:
+            digests = chunk_multi(fname, algoIDs, blocksize, method)
+            if fingerprint(os.stat(fname)) != tuple(fp):
+                logger.info("File changed while hashing, deferred: " + fname)
+                digests = None
+            out.append(digests)
+        except OSError as e:
+            logger.warning("Could not hash " + fname + ": " + str(e))
+            out.append(None)
+    return out
+
+def hash_files(files, algoIDs=None, workers=None, batch_bytes=8388608,
+               blocksize=DEFAULT_BLOCKSIZE, method='auto'):
+    """
+    Checksum many files in parallel threads.
+    
+    hashlib releases the GIL while digesting larger blocks, so threads keep several
+    cores and the disk queue busy. Small files are grouped into batches of about
+    `batch_bytes` per task to keep the per-task overhead low.
+    
+    **Parameters**  
+    ---------------
+    files: list  
+        *List of (file name, fingerprint) tuples, the fingerprint as made by  
+        `fingerprint` before hashing; a file with another fingerprint afterwards
+        is still being written.*  
+    algoIDs: tuple  
+        *Hashing algorithms, see `chunk_multi`.*  
+    workers: int  
+        *Number of threads, None for `default_workers()`.*  
+    batch_bytes: int  
+        *Approximate number of bytes to hash per task.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+    method: str  
+        *Read strategy, see `feed_file`.*  
+    
+    **Returns**  
+    ------------
+    list  
+        *Dicts as returned by `chunk_multi`, in the same order as `files`; None for  
+        files that could not be read or changed while being hashed.*
+    """
+    if workers is None:
+        workers = default_workers()
+    batches = []
+    batch = []
+    batch_size = 0
+    for fname, fp in files:
+        if batch and batch_size + fp[0] > batch_bytes:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append((fname, fp))
+        batch_size += fp[0]
+    if batch:
+        batches.append(batch)
+    if workers <= 1 or len(batches) <= 1:
+        results = [_hash_batch(b, algoIDs, blocksize, method) for b in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # map() hands the results back in submission order
+            results = list(pool.map(lambda b: _hash_batch(b, algoIDs, blocksize, method),
+                                    batches))
+    return [digests for result in results for digests in result]
+
+def autotune_blocksize(fname=None, blocksizes=BLOCKSIZES, algoIDs=('SHA256', 'MD5'),
+                      sample_bytes=33554432, repeats=2):
+    """
+    Find the fastest hashing block size on this machine.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *A sample file to hash, None to write a temporary file of random bytes.*  
+    blocksizes: tuple  
+        *Candidate block sizes in Bytes.*  
+    algoIDs: tuple  
+        *Hashing algorithms to time, as used in a sync run.*  
+    sample_bytes: int  
+        *Size of the temporary sample file.*  
+    repeats: int  
+        *Timings per block size, the best one counts.*  
+    
+    **Returns**  
+    ------------
+    blocksize: int  
+        *The fastest block size.*  
+    timings: dict  
+        *Block size as key, seconds as value.*  
+    """
+    remove = False
+    if fname is None:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            for i in range(0, sample_bytes, 1048576):
+                f.write(os.urandom(min(1048576, sample_bytes - i)))
+            fname = f.name
+        remove = True
+    timings = {}
+    try:
+        for blocksize in blocksizes:
+            for i in range(repeats):
+                start = time.perf_counter()
+                chunk_multi(fname, algoIDs, blocksize)
+                elapsed = time.perf_counter() - start
+                timings[blocksize] = min(elapsed, timings.get(blocksize, elapsed))
+    finally:
+        if remove:
+            os.remove(fname)
+    blocksize = min(timings, key=timings.get)
+    logger.info("Autotuned hashing block size: " + str(blocksize) + " bytes " +
+                str(timings))
+    return blocksize, timings
+
+def record_blocksize(blocksize, timings=None, fname=TUNING_FILE):
+    """
+    Save an (autotuned) block size, so it is only measured once per machine.
+    
+    **Parameters**  
+    ---------------
+    blocksize: int  
+        *Block size in Bytes.*  
+    timings: dict  
+        *Optional timings from `autotune_blocksize`, kept for reference.*  
+    fname: str  
+        *The tuning file.*  
+    """
+    tune = configparser.ConfigParser()
+    tune['Hashing'] = {'blocksize': str(blocksize),
+                       'tuned': str(dt.datetime.now().isoformat()),
+                       'cpus': str(os.cpu_count())}
+    if timings:
+        tune['Timings'] = dict((str(k), '%.4f' % v) for k, v in timings.items())
+    with open(fname, 'w') as f:
+        tune.write(f)
+
+def recorded_blocksize(fname=TUNING_FILE):
+    """
+    The block size saved by `record_blocksize`, None if there is none.
+    """
+    tune = configparser.ConfigParser()
+    tune.read(fname)
+    if tune.has_option('Hashing', 'blocksize'):
+        return tune.getint('Hashing', 'blocksize')
+    return None
+
+def tuned_blocksize(fname=TUNING_FILE):
+    """
+    The recorded block size for this machine, autotuning and recording it first when
+    there is none yet.
+
+    With `hashlib.file_digest` (Python 3.11+) single-hash reads, such as the primary
+    digest of every file, do not use the block size at all; the measurement is then
+    skipped and `DEFAULT_BLOCKSIZE` used for the few files hashed for several
+    hashtypes at once.
+    """
+    if hasattr(hashlib, 'file_digest'):
+        return recorded_blocksize(fname) or DEFAULT_BLOCKSIZE
+    blocksize = recorded_blocksize(fname)
+    if blocksize is None:
+        blocksize, timings = autotune_blocksize()
+        record_blocksize(blocksize, timings, fname)
+    return blocksize
+
+def is_sidecar(fname):
+    """
+    Check if a file is a sidecar checksum file next to the data file it describes.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *File name.*  
+    
+    **Returns**  
+    ------------
+    bool  
+        *True for e.g. 'x.mat.sha256' when 'x.mat' exists in the same folder.*  
+    """
+    for ext in SIDECARS:
+        if fname.endswith(ext) and os.path.isfile(fname[:-len(ext)]):
+            return True
+    return False
+
+def sidecar_paths(fname):
+    """
+    Existing sidecar checksum files for data file `fname`.
+    """
+    return [fname + ext for ext in SIDECARS if os.path.isfile(fname + ext)]
+
+def read_sidecars(fname, mtime_ns=None):
+    """
+    Read the digests from the sidecar checksum files of a data file.
+    
+    Sidecars hold the output of sha256sum or md5sum, i.e. a hex digest followed by
+    the file name. Sidecars older than the data file are ignored, since they were
+    written before the data file was last changed.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *Data file name.*  
+    mtime_ns: int  
+        *Modification time of the data file, None to stat it.*  
+    
+    **Returns**  
+    ------------
+    dict  
+        *algoID as key, the hash string as value, encoded like `chunk_multi` does.*  
+    """
+    if mtime_ns is None:
+        mtime_ns = os.stat(fname).st_mtime_ns
+    out = {}
+    for ext, algoID in SIDECARS.items():
+        try:
+            if os.stat(fname + ext).st_mtime_ns < mtime_ns:
+                logger.warning("Ignoring sidecar older than its data file: " + fname + ext)
+                continue
+            with open(fname + ext, 'r') as f:
+                fields = f.read(1024).split()
+        except (OSError, UnicodeDecodeError):
+            continue
+        try:
+            raw = bytes.fromhex(fields[0])
+        except (IndexError, ValueError):
+            logger.warning("Ignoring malformed sidecar: " + fname + ext)
+            continue
+        spec = HASHTYPES[hashtype_of(algoID)]
+        if len(raw) != spec.constructor().digest_size:
+            logger.warning("Ignoring malformed sidecar: " + fname + ext)
+            continue
+        out[algoID] = spec.encode(raw)
+    return out
+
+def fingerprint(info):
+    """
+    Reduce a stat result to the fingerprint that digest catalog entries are keyed by.
+    
+    **Parameters**  
+    ---------------
+    info: object  
+        *An os.stat_result.*  
+    
+    **Returns**  
+    ------------
+    tuple  
+        *(size, mtime_ns, inode)*  
+    """
+    return (info.st_size, info.st_mtime_ns, info.st_ino)
+
+def make_hash_string(fname, algoID, size=None):
     """
     Checksum file with filename and return it's hash according to algoID.
     
@@ -68,27 +610,24 @@ def make_hash_string(fname, algoID):
     fname: str  
         *File name.*  
     algoID: str  
-        *String indicating hashing algorithm, either['SHA256', 'MD5]*  
+        *String indicating hashing algorithm of a registered hashtype, e.g. 'SHA256'  
+        or 'MD5'.*  
+    size: int  
+        *File size as found by `labsync.scanner.scan`, None to stat the file.*  
     
     **Returns**
     ------------
     str  
         *String containing: algoID hash bytesize*
     """
-    if not os.path.exists(fname):
-        logger.critical("The file " + fname + " does not exist.") 
-        raise ValueError("The file " + fname + " does not exist.") 
-    info = os.stat(fname)
-    byte_s = str(info.st_size)
-    if 'SHA' in algoID:
-        hasj = chunk_sha256(fname).decode('utf-8')
-        algoID = 'SHA256'
-    elif 'MD' in algoID:
-        hasj = chunk_md5(fname)
-        algoID = 'MD5'
-    else:
-        logger.critical("A non-implemented or wrong algoID was given.") 
-        raise ValueError("A non-implemented or wrong algoID was given.") 
+    if size is None:
+        if not os.path.exists(fname):
+            logger.critical("The file " + fname + " does not exist.") 
+            raise ValueError("The file " + fname + " does not exist.") 
+        size = os.stat(fname).st_size
+    byte_s = str(size)
+    algoID = HASHTYPES[hashtype_of(algoID)].algoID
+    hasj = chunk_multi(fname, (algoID,))[algoID]
     return algoID + ' ' + hasj + ' ' + byte_s
 
 def compare(hash1, hash2):
@@ -156,6 +695,7 @@ def testcase():
     """
     Test/simulate some scenario's.
     """
+    from labsync import setops as so
     yodalist = simulate_list(n=120000)#on yoda, say 120 thousand files
     locallist = simulate_list(n=600)#on workstation (new, so to upload)
     extralist = random.sample(yodalist, 300)#still on workstation, on yoda
@@ -165,11 +705,7 @@ def testcase():
     local = np.asarray(locallist)
     remote.sort()
     local.sort()
-    #but without looping?...
-    totrash = []
-    for f in local:
-        hitbool = f == remote
-        if np.any(hitbool):# should there be duplicates somehow on yoda
-            totrash.append(f)
+    # one vectorized binary search instead of a loop
+    totrash= list(local[so.member(local, remote)])
     return remote, local, totrash
     
\ No newline at end of file
@@ -6,6 +6,7 @@ import datetime as dt
 import numpy as np
 from collections import OrderedDict
 import pkg_resources  # part of setuptools
+from labsync import checksum as cs
 
 __version__ = pkg_resources.require("labsync")[0].version
 __email__ = 'j.c.vanelst@uu.nl'
@@ -64,13 +65,75 @@ trash_fname     TEXT,
 trash_oripath       TEXT,
 trash_os        TEXT,
 trash_box_id        TEXT,
-trash_trashed_bool      INTEGER
+trash_trashed_bool      INTEGER,
+trash_size      INTEGER,
+trash_mtime_ns      INTEGER,
+trash_inode     INTEGER
 
+);
+CREATE TABLE digest(
+id      INTEGER PRIMARY KEY AUTOINCREMENT,
+digest_full_path        TEXT UNIQUE,
+digest_size     INTEGER,
+digest_mtime_ns     INTEGER,
+digest_inode        INTEGER,
+digest_sha2     TEXT,
+digest_md5      TEXT,
+digest_timestamp        TEXT,
+digest_verified     TEXT
+);
+CREATE TABLE vault_status(
+id      INTEGER PRIMARY KEY AUTOINCREMENT,
+status_full_path        TEXT UNIQUE,
+status_size     INTEGER,
+status_mtime_ns     INTEGER,
+status_inode        INTEGER,
+status_hashtype     TEXT,
+status_vault        TEXT,
+status_index        TEXT,
+status_timestamp        TEXT
 );
 """
 """
 Custom code to create the database.
 """
+
+#used to bring databases of older workstations up to date
+db_upgrade = """CREATE TABLE IF NOT EXISTS digest(
+id      INTEGER PRIMARY KEY AUTOINCREMENT,
+digest_full_path        TEXT UNIQUE,
+digest_size     INTEGER,
+digest_mtime_ns     INTEGER,
+digest_inode        INTEGER,
+digest_sha2     TEXT,
+digest_md5      TEXT,
+digest_timestamp        TEXT,
+digest_verified     TEXT
+);
+CREATE TABLE IF NOT EXISTS vault_status(
+id      INTEGER PRIMARY KEY AUTOINCREMENT,
+status_full_path        TEXT UNIQUE,
+status_size     INTEGER,
+status_mtime_ns     INTEGER,
+status_inode        INTEGER,
+status_hashtype     TEXT,
+status_vault        TEXT,
+status_index        TEXT,
+status_timestamp        TEXT
+);
+"""
+"""
+Statements that add tables introduced after the first release to an existing database.
+"""
+
+db_upgrade_columns = [('digest', 'digest_verified', 'TEXT'),
+                      ('trash', 'trash_size', 'INTEGER'),
+                      ('trash', 'trash_mtime_ns', 'INTEGER'),
+                      ('trash', 'trash_inode', 'INTEGER'),
+                      ('vault_status', 'status_vault', 'TEXT')]
+"""
+(table, column, type) of columns added to existing tables after their introduction.
+"""
 #make sure all types are ok (in the numpy result arrays)
 db_types = {'sync_run': {'id': '<i4', 
                             'timestamp_start': 'U26',
@@ -84,26 +147,60 @@ db_types = {'sync_run': {'id': '<i4',
                          'upload_full_path': 'U1024',
                          'upload_rela_path': 'U1024',
                          'upload_timestamp': 'U26',
-                         'upload_checksum': 'U50',
-                         'upload_checksum_type': 'U5',
+                         'upload_checksum_type': 'U16',
                          'upload_count' : '<i4',
                          },
             'trash': {'id': '<i4',
                         'trash_timestamp_entrance': 'U26',
                         'trash_timestamp_exit': 'U26',
-                        'trash_checksum': 'U50',
-                        'trash_checksum_type': 'U5',
+                        'trash_checksum_type': 'U16',
                         'trash_fname':'U1024',
                         'trash_oripath':'U1024',
                         'trash_os':'U10',
                         'trash_box_id':'U24',
                         'trash_trashed_bool':'<i1',
+                        'trash_size':'<i8',
+                        'trash_mtime_ns':'<i8',
+                        'trash_inode':'<i8',
+                        },
+            'digest': {'id': '<i4',
+                        'digest_full_path': 'U1024',
+                        'digest_size': '<i8',
+                        'digest_mtime_ns': '<i8',
+                        'digest_inode': '<i8',
+                        'digest_timestamp': 'U26',
+                        'digest_verified': 'U26',
+                        },
+            'vault_status': {'id': '<i4',
+                        'status_full_path': 'U1024',
+                        'status_size': '<i8',
+                        'status_mtime_ns': '<i8',
+                        'status_inode': '<i8',
+                        'status_hashtype': 'U16',
+                        'status_vault': 'U64',
+                        'status_index': 'U50',
+                        'status_timestamp': 'U26',
                         }
             }
 """
-Custom structured array specification for the database dtypes.
+Custom structured array specification for the database dtypes. The checksum columns
+are left out: they are as wide as the longest registered digest, see `column_dtype`.
+"""
+
+CHECKSUM_COLUMNS = ('upload_checksum', 'trash_checksum')
+"""
+Columns with a checksum string, besides the 'digest_<hashtype>' columns.
 """
 
+def column_dtype(table, column):
+    """
+    The numpy dtype of a column in the result arrays, see `db_types`.
+    """
+    if (column in CHECKSUM_COLUMNS or
+            (table == 'digest' and column[len('digest_'):] in cs.HASHTYPES)):
+        return 'U' + str(cs.digest_width())
+    return db_types[table][column]
+
 class dbManager(object):
     """
     Manages the local data I/O and counts using sqlite database.
@@ -218,8 +315,7 @@ class dbManager(object):
         res = self.cursor.execute(cmd)
         numrows = int(self.cursor.rowcount)
         #check dtypes etc to format array
-        table_oi = db_types[table]
-        dtypes = [table_oi[column] for column in columns]
+        dtypes = [column_dtype(table, column) for column in columns]
         myzip = list(zip(columns, dtypes))
         spec = [zipvalue for zipvalue in myzip]
         arres = np.fromiter(self.cursor.fetchall(), count=numrows, dtype=spec)
@@ -264,8 +360,7 @@ class dbManager(object):
         res = self.cursor.execute(cmd)
         numrows = int(self.cursor.rowcount)
         #check dtypes etc to format array
-        table_oi = db_types[table]
-        dtypes = [table_oi[column] for column in columns]
+        dtypes = [column_dtype(table, column) for column in columns]
         myzip = list(zip(columns, dtypes))
         spec = [zipvalue for zipvalue in myzip]
         arres = np.fromiter(self.cursor.fetchall(), count=numrows, dtype=spec)
@@ -279,7 +374,231 @@ class dbManager(object):
         self.cursor.execute("""SELECT max(id) FROM %s """ %(table))
         max_id = self.cursor.fetchone()[0]
         return max_id
-        
+
+    def digest_columns(self):
+        """
+        The digest catalog column of every registered hashtype, added when missing.
+
+        **Returns**  
+        -----------
+        columns: OrderedDict  
+            *Hashtype as key, column name ('digest_<hashtype>') as value.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.digest_columns")
+        columns = OrderedDict((hashtype, 'digest_' + hashtype) for hashtype in cs.HASHTYPES)
+        present = [row[1] for row in self.cursor.execute("PRAGMA table_info(digest)")]
+        for column in columns.values():
+            if column not in present:
+                cmd = "ALTER TABLE digest ADD COLUMN %s TEXT" %(column)
+                if self.debug:
+                    logger.info(cmd)
+                self.cursor.execute(cmd)
+        return columns
+
+    def load_digests(self):
+        """
+        Load the local digest catalog.
+
+        **Returns**  
+        -----------
+        catalog: dict  
+            *Full path as key, (fingerprint, digests) as value, where fingerprint is  
+            the (size, mtime_ns, inode) tuple the digests were made for and digests a
+            dict with hashtype as key and the hash string as value. Digests that were
+            never computed are absent.*
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.load_digests")
+        columns = self.digest_columns()
+        cmd = ("SELECT digest_full_path, digest_size, digest_mtime_ns, digest_inode, " +
+               ", ".join(columns.values()) + " FROM digest")
+        if self.debug:
+            logger.info(cmd)
+        self.cursor.execute(cmd)
+        catalog = {}
+        for row in self.cursor.fetchall():
+            digests = dict((hashtype, digest) for hashtype, digest in
+                           zip(columns, row[4:]) if digest is not None)
+            catalog[row[0]] = (tuple(row[1:4]), digests)
+        return catalog
+
+    def store_digests(self, entries):
+        """
+        Insert or replace digest catalog entries (commit afterwards).
+
+        **Parameters**  
+        ---------------
+        entries: list  
+            *List of (full path, fingerprint, digests) tuples, digests being a dict  
+            with hashtype as key.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.store_digests")
+        columns = self.digest_columns()
+        now = str(dt.datetime.now().isoformat())
+        rows = [(path, fp[0], fp[1], fp[2], now) +
+                tuple(digests.get(hashtype) for hashtype in columns)
+                for path, fp, digests in entries]
+        cmd = ("INSERT OR REPLACE INTO digest (digest_full_path, digest_size, " +
+               "digest_mtime_ns, digest_inode, digest_timestamp, " +
+               ", ".join(columns.values()) + ") VALUES (" +
+               ", ".join(["?"] * (5 + len(columns))) + ");")
+        if self.debug:
+            logger.info(cmd + " (" + str(len(rows)) + " rows)")
+        self.cursor.executemany(cmd, rows)
+
+    def forget_digests(self, paths):
+        """
+        Remove digest catalog entries (commit afterwards).
+
+        **Parameters**  
+        ---------------
+        paths: list  
+            *Full paths of files that no longer need a catalog entry.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.forget_digests")
+        cmd = "DELETE FROM digest WHERE digest_full_path = ?;"
+        if self.debug:
+            logger.info(cmd + " (" + str(len(paths)) + " rows)")
+        self.cursor.executemany(cmd, [(path,) for path in paths])
+
+    def verified_digest(self, path):
+        """
+        Record that the cached digests of a file were just checked (commit afterwards).
+
+        **Parameters**  
+        ---------------
+        path: str  
+            *Full path of the file.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.verified_digest")
+        cmd = "UPDATE digest SET digest_verified = ? WHERE digest_full_path = ?;"
+        if self.debug:
+            logger.info(cmd)
+        self.cursor.execute(cmd, (str(dt.datetime.now().isoformat()), path))
+
+    def load_vault_status(self):
+        """
+        Load the vault status of local files, as found in the previous runs.
+
+        **Returns**  
+        -----------
+        statuses: dict  
+            *Full path as key, (fingerprint, hashtype, index, vault) as value: the  
+            (size, mtime_ns, inode) tuple the status is valid for, the hashtype of the  
+            digest found in the vault ('' if the file was not in the vault), the  
+            source SHA256 of the vault index it was classified against and the name  
+            of the vault it was found in ('' if unknown).*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.load_vault_status")
+        cmd = ("SELECT status_full_path, status_size, status_mtime_ns, status_inode, " +
+               "status_hashtype, status_index, status_vault FROM vault_status")
+        if self.debug:
+            logger.info(cmd)
+        self.cursor.execute(cmd)
+        return dict((row[0], (tuple(row[1:4]), row[4], row[5], row[6] or ''))
+                    for row in self.cursor.fetchall())
+
+    def store_vault_status(self, entries, index):
+        """
+        Insert or replace vault status entries (commit afterwards).
+
+        **Parameters**  
+        ---------------
+        entries: list  
+            *List of (full path, fingerprint, hashtype, vault) tuples, hashtype '' for  
+            files that are not in the vault, vault '' when not known.*  
+        index: str  
+            *Source SHA256 of the vault index the files were classified against.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.store_vault_status")
+        now = str(dt.datetime.now().isoformat())
+        rows = [(path, fp[0], fp[1], fp[2], hashtype, vault, index, now)
+                for path, fp, hashtype, vault in entries]
+        cmd = ("INSERT OR REPLACE INTO vault_status (status_full_path, status_size, " +
+               "status_mtime_ns, status_inode, status_hashtype, status_vault, " +
+               "status_index, status_timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);")
+        if self.debug:
+            logger.info(cmd + " (" + str(len(rows)) + " rows)")
+        self.cursor.executemany(cmd, rows)
+
+    def advance_vault_status(self, paths, previous, index):
+        """
+        Mark the statuses of `paths` found against vault index `previous` as valid for
+        `index` (commit afterwards). Only for files that were checked against the
+        difference and unaffected by it; others keep `previous` and are looked up
+        again when they are classified next.
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.advance_vault_status")
+        cmd = ("UPDATE vault_status SET status_index = ? WHERE status_full_path = ? " +
+               "AND status_index = ?;")
+        if self.debug:
+            logger.info(cmd)
+        self.cursor.executemany(cmd, [(index, path, previous) for path in paths])
+
+    def forget_vault_status(self, paths):
+        """
+        Remove vault status entries (commit afterwards).
+
+        **Parameters**  
+        ---------------
+        paths: list  
+            *Full paths of files that were not classified.*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.forget_vault_status")
+        cmd = "DELETE FROM vault_status WHERE status_full_path = ?;"
+        if self.debug:
+            logger.info(cmd + " (" + str(len(paths)) + " rows)")
+        self.cursor.executemany(cmd, [(path,) for path in paths])
+
+    def seed_digests(self):
+        """
+        Seed the digest catalog from checksums recorded in the upload and trash tables.
+
+        A recorded checksum is only taken over when the file still exists and has not
+        been modified after the checksum was recorded; its current stat fingerprint
+        is then stored with it. Paths already in the catalog are left alone.
+
+        Only done once, by `upgrade_db` when it creates the digest table: from then on
+        the catalog is leading, and a digest dropped because the file no longer
+        matches it (see `labsync.scrub`) must not be seeded back from the upload table.
+
+        **Returns**  
+        -----------
+        seeded: int  
+            *Number of catalog entries added (committed).*  
+        """
+        logger = logging.getLogger("Labdata_cleanup.database.dbManager.seed_digests")
+        self.cursor.execute("SELECT digest_full_path FROM digest")
+        known = set(row[0] for row in self.cursor.fetchall())
+        self.cursor.execute("SELECT upload_full_path, upload_checksum, " +
+                            "upload_checksum_type, upload_timestamp FROM upload")
+        recorded = self.cursor.fetchall()
+        self.cursor.execute("SELECT trash_oripath, trash_checksum, trash_checksum_type, " +
+                            "trash_timestamp_entrance FROM trash WHERE trash_trashed_bool = 0")
+        recorded += self.cursor.fetchall()
+        seeds = {}
+        for path, checksum, checksumtype, timestamp in recorded:
+            if path in known or not checksum or not timestamp:
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            try:
+                recorded_at = dt.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+            except ValueError:
+                continue
+            if dt.datetime.fromtimestamp(info.st_mtime) >= recorded_at:
+                continue # modified after the checksum was made, must be rehashed
+            if checksumtype not in cs.HASHTYPES:
+                continue
+            seed = seeds.setdefault(path, (cs.fingerprint(info), {}))
+            seed[1][checksumtype] = checksum
+        self.store_digests([(path, fp, digests) for path, (fp, digests) in seeds.items()])
+        self.commit()
+        if self.debug:
+            logger.info("Seeded " + str(len(seeds)) + " digest catalog entries.")
+        return len(seeds)
+
 def test(name='mac3db.sqlite'):
     """
     Quick and simple testing of some queries on some database (that must exist).
@@ -318,3 +637,28 @@ def build_db(name='mac3db.sqlite'):
         print ('The database', name, 'was created.')
     else:
         print ('The database', name, 'already exists. Please remove it and retry... ')
+
+def upgrade_db(name='mac3db.sqlite'):
+    """
+    Add tables and columns introduced by newer package versions to an existing database.
+
+    **Parameters**  
+    --------------
+    name: str  
+        *A name for the the DB.*  
+    """
+    conn = sqlite3.connect(name)
+    c = conn.cursor()
+    tables = [row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    c.executescript(db_upgrade)
+    for table, column, coltype in db_upgrade_columns:
+        columns = [row[1] for row in c.execute("PRAGMA table_info(%s)" %(table))]
+        if column not in columns:
+            c.execute("ALTER TABLE %s ADD COLUMN %s %s" %(table, column, coltype))
+    conn.commit()
+    conn.close()
+    if 'digest' not in tables:
+        # checksums of earlier runs spare hashing those files again, see seed_digests
+        seeded = dbManager(name, debug=False).seed_digests()
+        mylogger.info("Seeded digest catalog with " + str(seeded) +
+                      " checksums known from upload/trash tables.")
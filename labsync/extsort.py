@@ -0,0 +1,277 @@
+import os
+import tempfile
+import logging
+import numpy as np
+import pkg_resources  # part of setuptools
+
+from labsync import setops as so
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Out-of-core sorting and merge-join of digest arrays, for a memory ceiling.
+
+On workstations with little memory a vault index with millions of entries should
+not be sorted or compared in one piece. `SortedRuns` is an external sort: records
+are collected up to the memory ceiling, sorted, and spilled to temporary run files;
+the runs are then merged back in sorted blocks. `merge_join` streams two sorted
+block sequences past each other once, O(n + m), to find the local digests that are
+in the vault. `member_external` combines both, as a low-memory `labsync.setops.member`.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.extsort")
+
+MERGE_FANIN = 16
+"""
+Most runs merged at once; with more runs they are first merged into longer runs.
+"""
+
+MIN_BLOCK = 1024
+"""
+Fewest records read from a run at a time, even if the memory ceiling is smaller.
+"""
+
+class _RunReader(object):
+    """
+    Reads a run file back in blocks of `count` records.
+    """
+    def __init__(self, fname, dtype, count):
+        self.f = open(fname, 'rb')
+        self.dtype = dtype
+        self.count = count
+
+    def next_block(self):
+        block = np.fromfile(self.f, dtype=self.dtype, count=self.count)
+        if not len(block):
+            self.f.close()
+        return block
+
+class SortedRuns(object):
+    """
+    External sort of fixed width records within a memory ceiling.
+    """
+    def __init__(self, dtype, memory_bytes, order=None, tmpdir=None):
+        """
+        **Parameters**  
+        ---------------
+        dtype: numpy dtype  
+            *Record type, e.g. 'S32' or a structured type.*  
+        memory_bytes: int  
+            *Memory to use for buffering records.*  
+        order: str  
+            *Field to sort on for a structured dtype, None to sort whole records.*  
+        tmpdir: str  
+            *Directory for the run files, None for the system default.*  
+        """
+        self.dtype = np.dtype(dtype)
+        self.limit = max(1, int(memory_bytes) // self.dtype.itemsize)
+        self.order = order
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+        self.count = 0
+
+    def _key(self, array):
+        return array[self.order] if self.order else array
+
+    def _sort(self, array):
+        return np.sort(array, order=self.order) if self.order else np.sort(array)
+
+    def add(self, array):
+        """
+        Add records; a sorted run is spilled to disk whenever the buffer is full.
+        """
+        array = np.asarray(array, dtype=self.dtype)
+        self.buffer.append(array)
+        self.buffered += len(array)
+        self.count += len(array)
+        if self.buffered >= self.limit:
+            self._spill()
+
+    def _spill(self):
+        if not self.buffered:
+            return
+        run = self._sort(np.concatenate(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        fd, fname = tempfile.mkstemp(prefix='labsync_run_', suffix='.bin', dir=self.tmpdir)
+        with os.fdopen(fd, 'wb') as f:
+            run.tofile(f)
+        self.runs.append(fname)
+
+    def blocks(self):
+        """
+        Yield all records in sorted order, as a sequence of sorted blocks.
+
+        At most `MERGE_FANIN` runs are merged at once; more runs are first merged
+        into longer runs on disk.
+        """
+        if not self.runs:
+            if self.buffered:
+                yield self._sort(np.concatenate(self.buffer))
+            return
+        self._spill()
+        while len(self.runs) > MERGE_FANIN:
+            group, self.runs = self.runs[:MERGE_FANIN], self.runs[MERGE_FANIN:]
+            fd, fname = tempfile.mkstemp(prefix='labsync_run_', suffix='.bin',
+                                         dir=self.tmpdir)
+            self.runs.append(fname)
+            with os.fdopen(fd, 'wb') as f:
+                for block in self._merge(group):
+                    block.tofile(f)
+            for name in group:
+                os.remove(name)
+        for block in self._merge(self.runs):
+            yield block
+
+    def _merge(self, runs):
+        """
+        Merge run files into sorted blocks.
+
+        Every run keeps one block of about `memory_bytes / (runs + 1)` in memory. The
+        records up to the smallest last key among those blocks can all be emitted,
+        since every run continues with larger keys.
+        """
+        per_run = max(MIN_BLOCK, self.limit // (len(runs) + 1))
+        readers = [_RunReader(fname, self.dtype, per_run) for fname in runs]
+        blocks = [reader.next_block() for reader in readers]
+        while True:
+            active = [i for i, block in enumerate(blocks) if len(block)]
+            if not active:
+                return
+            bound = min(self._key(blocks[i])[-1] for i in active)
+            parts = []
+            for i in active:
+                cut = np.searchsorted(self._key(blocks[i]), bound, side='right')
+                parts.append(blocks[i][:cut])
+                blocks[i] = blocks[i][cut:]
+                if not len(blocks[i]):
+                    blocks[i] = readers[i].next_block()
+            yield self._sort(np.concatenate(parts))
+
+    def close(self):
+        """
+        Remove the run files.
+        """
+        for fname in self.runs:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        self.runs = []
+
+def array_blocks(array, count):
+    """
+    Yield consecutive blocks of `count` records of a (memory mapped) array.
+    """
+    for start in range(0, len(array), count):
+        yield np.asarray(array[start:start + count])
+
+def indexed_blocks(local, count):
+    """
+    Yield consecutive blocks of `count` digests as records with fields 'key' (the
+    digest) and 'idx' (its position in `local`), as `merge_join` expects them.
+    """
+    dtype = np.dtype([('key', local.dtype), ('idx', '<i8')])
+    for start in range(0, len(local), count):
+        keys = np.asarray(local[start:start + count])
+        block = np.zeros(len(keys), dtype=dtype)
+        block['key'] = keys
+        block['idx'] = np.arange(start, start + len(keys))
+        yield block
+
+def merge_join(local_blocks, vault_blocks):
+    """
+    Stream two sorted block sequences past each other to find common keys.
+
+    **Parameters**  
+    ---------------
+    local_blocks: iterable  
+        *Sorted blocks of a structured array with fields 'key' and 'idx'.*  
+    vault_blocks: iterable  
+        *Sorted blocks of vault keys.*  
+
+    **Yields**  
+    ----------
+    idx: array-like  
+        *The 'idx' values of local records whose key is in the vault.*  
+    """
+    vault_blocks = iter(vault_blocks)
+    vault = next(vault_blocks, None)
+    for local in local_blocks:
+        keys = local['key']
+        if not len(keys):
+            continue
+        found = np.zeros(len(keys), dtype=bool)
+        while vault is not None:
+            if len(vault):
+                # only the local keys within the range of this vault block
+                lo = np.searchsorted(keys, vault[0], side='left')
+                hi = np.searchsorted(keys, vault[-1], side='right')
+                found[lo:hi] |= so.member(keys[lo:hi], vault)
+                if vault[-1] >= keys[-1]:
+                    break # the vault block may match the next local block too, keep it
+            vault = next(vault_blocks, None)
+        yield local['idx'][found]
+
+def member_external(local, vault, memory_bytes, valid=None, tmpdir=None):
+    """
+    `labsync.setops.member` within a memory ceiling.
+
+    **Parameters**  
+    ---------------
+    local: array-like  
+        *Local digests, any order.*  
+    vault: array-like or SortedRuns  
+        *Vault digests, **sorted**; read sequentially, e.g. a memory mapped array, or  
+        the runs of an external sort.*
+    memory_bytes: int  
+        *Memory ceiling for sorting the local digests and buffering vault blocks.*  
+    valid: array-like  
+        *Optional boolean mask; local digests where it is False never match.*  
+    tmpdir: str  
+        *Directory for run files.*  
+
+    **Returns**  
+    ------------
+    found: array-like  
+        *Boolean array aligned with `local`.*  
+    """
+    local = np.asarray(local)
+    found = np.zeros(len(local), dtype=bool)
+    if isinstance(vault, SortedRuns):
+        vault_blocks = vault.blocks()
+        vault_count = vault.count
+    else:
+        count = max(1, (memory_bytes // 2) // vault.dtype.itemsize)
+        vault_blocks = array_blocks(vault, count)
+        vault_count = len(vault)
+    if not len(local) or not vault_count:
+        return found
+    dtype = np.dtype([('key', local.dtype), ('idx', '<i8')])
+    runs = SortedRuns(dtype, memory_bytes // 2, order='key', tmpdir=tmpdir)
+    for block in indexed_blocks(local, max(1, runs.limit)):
+        if valid is not None:
+            block = block[np.asarray(valid[block['idx']], dtype=bool)]
+        runs.add(block)
+    try:
+        for idx in merge_join(runs.blocks(), vault_blocks):
+            found[idx] = True
+    finally:
+        runs.close()
+    return found
+
+def member_sorted(local, vault, memory_bytes):
+    """
+    `member_external` for local digests that are sorted already, such as the array
+    of a previous binary index: both arrays are only read sequentially, in blocks.
+    """
+    found = np.zeros(len(local), dtype=bool)
+    if not len(local) or not len(vault):
+        return found
+    local_count = max(1, (memory_bytes // 2) // (local.dtype.itemsize + 8))
+    vault_count = max(1, (memory_bytes // 2) // vault.dtype.itemsize)
+    for idx in merge_join(indexed_blocks(local, local_count), array_blocks(vault, vault_count)):
+        found[idx] = True
+    return found
@@ -0,0 +1,240 @@
+import os
+import re
+import shutil
+import hashlib
+import configparser
+import datetime as dt
+import logging
+import pkg_resources  # part of setuptools
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Fetching the vault index file from YODA.
+
+The previous download is kept together with a small cache file holding the ETag and
+Last-Modified headers it came with. The next download is a conditional GET: when the
+index did not change the server answers '304 Not Modified' and nothing is
+transferred. The cache file also records when the local copy was last confirmed to
+match the vault, so callers can refuse to decide deletions on a stale copy.
+
+The index mostly grows by lines appended as data is approved into the vault. In
+incremental mode only the new tail is fetched, with a Range request that starts a
+little before the end of the previous download; the overlap must hash to the
+recorded tail hash, otherwise the index was rewritten and is downloaded in full.
+
+Plain text indexes are requested with 'Accept-Encoding: gzip' and decoded while
+streaming to disk. Index files that are compressed on the server ('.gz', '.xz') are
+stored as they are; `labsync.vaultindex` decompresses them while parsing.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.indexfetch")
+
+DOWNLOAD_CHUNK = 1048576
+"""
+Bytes per chunk when streaming a download to disk.
+"""
+
+COMPRESSED = ('.gz', '.xz')
+"""
+Extensions of index files that are compressed on the server.
+"""
+
+TAIL_BYTES = 4096
+"""
+Length of the tail of the previous download that is hashed and fetched again as
+overlap in incremental mode.
+"""
+
+def cache_file(local):
+    """
+    Name of the cache file that goes with the local copy of the index.
+    """
+    return local + '.cache.ini'
+
+def read_cache(local):
+    """
+    The [Download] section of the cache file, an empty dict if there is none.
+    """
+    cache = configparser.ConfigParser(interpolation=None)
+    cache.read(cache_file(local))
+    if not cache.has_section('Download') or not os.path.isfile(local):
+        return {}
+    return dict(cache['Download'])
+
+def write_cache(local, values):
+    """
+    Save the [Download] section of the cache file.
+    """
+    cache = configparser.ConfigParser(interpolation=None)
+    cache['Download'] = dict((k, str(v)) for k, v in values.items() if v is not None)
+    with open(cache_file(local) + '.tmp', 'w') as f:
+        cache.write(f)
+    os.replace(cache_file(local) + '.tmp', cache_file(local))
+
+def isotime(iso_string):
+    """
+    A datetime back from its isoformat(), which leaves out a zero microsecond.
+    """
+    if '.' in iso_string:
+        return dt.datetime.strptime(iso_string, '%Y-%m-%dT%H:%M:%S.%f')
+    return dt.datetime.strptime(iso_string, '%Y-%m-%dT%H:%M:%S')
+
+def verified_at(local):
+    """
+    When the local copy was last confirmed to match the vault, None if never.
+    """
+    cache = read_cache(local)
+    if 'verified' not in cache:
+        return None
+    return isotime(cache['verified'])
+
+def tail_sha256(fname, length=None):
+    """
+    Hex SHA256 of the last `TAIL_BYTES` of the first `length` bytes of a file.
+    """
+    if length is None:
+        length = os.path.getsize(fname)
+    start = max(0, length - TAIL_BYTES)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha256(f.read(length - start)).hexdigest()
+
+def _range_start(response):
+    """
+    First byte position of a 206 response, None if the header is missing or odd.
+    """
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+def _chunks(response, remote):
+    """
+    The response body in chunks: decoded for a transfer encoding such as gzip, but
+    as stored on the server for compressed index files.
+    """
+    if remote.endswith(COMPRESSED):
+        return response.raw.stream(DOWNLOAD_CHUNK, decode_content=False)
+    return response.iter_content(DOWNLOAD_CHUNK)
+
+def _append_tail(response, local, part, cache):
+    """
+    Write the previous download plus the new tail of a 206 response to `part`.
+
+    Returns the number of new bytes, None when the overlap does not match the
+    recorded tail (nothing is written then).
+    """
+    length = int(cache['length'])
+    offset = max(0, length - TAIL_BYTES)
+    if _range_start(response) != offset:
+        return None
+    chunks = _chunks(response, cache['remote'])
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= length - offset:
+            break
+    if hashlib.sha256(head[:length - offset]).hexdigest() != cache['tail_sha256']:
+        return None
+    shutil.copyfile(local, part)
+    added = len(head) - (length - offset)
+    with open(part, 'ab') as f:
+        f.write(head[length - offset:])
+        for chunk in chunks:
+            f.write(chunk)
+            added += len(chunk)
+    return added
+
+def fetch_index(server, remote, local, reuse_seconds=0, incremental=False):
+    """
+    Download the vault index, unless the local copy is still current.
+
+    **Parameters**  
+    ---------------
+    server: object  
+        *Easywebdav instantiated class object.*  
+    remote: str  
+        *Path of the index file on the server.*  
+    local: str  
+        *Path of the local copy.*  
+    reuse_seconds: float  
+        *Reuse the local copy without asking the server when it was confirmed  
+        less than this many seconds ago.*
+    incremental: bool  
+        *Fetch only what was appended since the previous download.*  
+
+    **Returns**  
+    ------------
+    changed: bool  
+        *True if a new copy was downloaded.*  
+    verified: datetime  
+        *When the local copy was confirmed to match the vault.*  
+
+    **Notes**  
+    ---------
+    A new copy is written next to the old one and only moved in place when it is
+    complete. Connection errors are raised; the local copy is then left alone.
+    Servers that ignore the Range header answer with the whole file, which is used
+    as a full download. A local copy whose size differs from the downloaded one is
+    downloaded again unconditionally.
+    """
+    cache = read_cache(local)
+    now = dt.datetime.now()
+    if cache.get('remote') != remote:
+        cache = {}
+    if 'length' in cache and str(os.path.getsize(local)) != cache['length']:
+        # the local copy was changed or cut short, a 304 must not confirm it
+        logger.warning("Local copy of the vault index " + local + " has another size " +
+                       "than downloaded, downloading it in full.")
+        cache = {}
+    verified = verified_at(local) if cache else None
+    if verified and (now - verified).total_seconds() < reuse_seconds:
+        logger.info("Reusing vault index confirmed at " + verified.isoformat())
+        return False, verified
+    headers = {}
+    if 'etag' in cache:
+        headers['If-None-Match'] = cache['etag']
+    if 'last_modified' in cache:
+        headers['If-Modified-Since'] = cache['last_modified']
+    # byte ranges only make sense on the file as stored, not on a gzip transfer
+    headers['Accept-Encoding'] = 'identity' if remote.endswith(COMPRESSED) else 'gzip'
+    if (incremental and 'tail_sha256' in cache and not remote.endswith(COMPRESSED) and
+            str(os.path.getsize(local)) == cache.get('length')):
+        headers['Range'] = 'bytes=' + str(max(0, int(cache['length']) - TAIL_BYTES)) + '-'
+        headers['Accept-Encoding'] = 'identity'
+    response = server._send('GET', remote, (200, 206, 304, 416), headers=headers,
+                            stream=True)
+    if response.status_code == 304:
+        response.close()
+        cache['verified'] = now.isoformat()
+        write_cache(local, cache)
+        logger.info("Vault index not modified since the previous download.")
+        return False, now
+    part = local + '.part'
+    if response.status_code == 206:
+        added = _append_tail(response, local, part, cache)
+        if added is None:
+            response.close()
+            logger.info("Vault index was changed before its previous end, downloading " +
+                        "it in full.")
+            return fetch_index(server, remote, local)
+        logger.info("Fetched " + str(added) + " bytes appended to the vault index.")
+    elif response.status_code == 416:
+        response.close()
+        logger.info("Vault index shrank, downloading it in full.")
+        return fetch_index(server, remote, local)
+    else:
+        added = 0
+        with open(part, 'wb') as f:
+            for chunk in _chunks(response, remote):
+                f.write(chunk)
+                added += len(chunk)
+        logger.info("Downloaded vault index, " + str(added) + " bytes.")
+    os.replace(part, local)
+    length = os.path.getsize(local)
+    write_cache(local, {'remote': remote,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'length': length,
+                        'tail_sha256': tail_sha256(local, length),
+                        'verified': now.isoformat()})
+    return True, now
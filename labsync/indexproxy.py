@@ -0,0 +1,342 @@
+import os
+import re
+import hmac
+import time
+import shutil
+import hashlib
+import socketserver
+import logging
+import threading
+import configparser
+import http.server
+import requests
+import pkg_resources  # part of setuptools
+
+from labsync import indexfetch as fi
+from labsync import vaultindex as vi
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """A vault index cache on the lab network, shared by all workstations.
+
+One machine runs the proxy (`labsync.sync.proxy_main`): it downloads the vault index
+from YODA, keeps it in binary form (see `labsync.vaultindex`) and serves that over
+HTTP. Workstations with an [IndexProxy] 'url' get the binary index from the proxy
+instead of downloading and parsing the text index themselves:
+
+- GET /manifest.ini: the manifest of the current binary index, with an ETag naming
+  the generation and an 'X-Labsync-Verified' header telling when the proxy last
+  confirmed it with the vault; 'If-None-Match' gives '304 Not Modified'.
+- GET /<generation>/<file>.npy: the arrays of that generation.
+
+Every refresh is published as a new generation directory, so a workstation never
+mixes arrays of two builds. Nothing of the vault is sent that a workstation does not
+download already; the proxy only saves the repeated downloads and parsing.
+
+Files are deleted on the strength of this index, so it is not taken on trust from
+whoever answers on the lab network: the proxy and the workstations share an
+[IndexProxy] 'secret'. The served manifest lists the SHA256 of every array in a
+[Files] section, and the manifest together with its confirmation time is signed
+with an HMAC in an 'X-Labsync-Signature' header. A workstation checks the signature
+(on a 304 too) and every array before it uses them.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.indexproxy")
+
+PUBLISHED = 'published'
+"""
+Directory of the proxy with one subdirectory per generation of the binary index.
+"""
+
+KEEP_GENERATIONS = 2
+"""
+Generations kept, so workstations that just fetched a manifest can finish.
+"""
+
+GENERATION = re.compile(r'[0-9a-f]{16}')
+"""
+Name of a generation directory, the only thing a request may name besides a file.
+"""
+
+INDEX_FILE = re.compile(r'[A-Za-z0-9_]+\.npy')
+"""
+Name of an array of the binary index.
+"""
+
+def index_files(manifest):
+    """
+    The .npy files that make up the binary index described by `manifest`.
+    """
+    names = []
+    for hashtype in manifest.get('Index', 'hashtypes').split():
+        names += [hashtype + '.npy', hashtype + '_sizes.npy', hashtype + '_vaults.npy']
+        if manifest.has_section('Diff'):
+            names += [hashtype + '_added.npy', hashtype + '_removed.npy']
+    return names
+
+def _hexdigest(fname):
+    myhash = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(fi.DOWNLOAD_CHUNK), b''):
+            myhash.update(chunk)
+    return myhash.hexdigest()
+
+def signature(secret, manifest, verified):
+    """
+    HMAC-SHA256 of the served manifest (bytes) and its confirmation time (isoformat).
+    """
+    message = manifest + b'\n' + verified.encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def publish(directory, root, verified):
+    """
+    Copy the binary index in `directory` to a new generation below `root`.
+
+    **Parameters**  
+    ---------------
+    directory: str  
+        *The binary index, see `labsync.vaultindex.open_index`.*  
+    root: str  
+        *Where the generations are kept.*  
+    verified: datetime  
+        *When the index was confirmed to match the vault.*  
+
+    **Returns**  
+    ------------
+    generation: str  
+        *Name of the generation directory, derived from the manifest.*  
+
+    **Notes**  
+    ---------
+    The manifest is published with a [Files] section added, the SHA256 of every
+    array, see `fetch_binary_index`.
+    """
+    with open(os.path.join(directory, 'manifest.ini'), 'rb') as f:
+        generation = hashlib.sha256(f.read()).hexdigest()[:16]
+    target = os.path.join(root, generation)
+    if not os.path.isdir(target):
+        manifest = vi.read_manifest(directory)
+        os.makedirs(target + '.tmp', exist_ok=True)
+        for name in index_files(manifest):
+            shutil.copyfile(os.path.join(directory, name), os.path.join(target + '.tmp', name))
+        manifest['Files'] = dict((name, _hexdigest(os.path.join(target + '.tmp', name)))
+                                 for name in index_files(manifest))
+        with open(os.path.join(target + '.tmp', 'manifest.ini'), 'w') as f:
+            manifest.write(f)
+        os.replace(target + '.tmp', target)
+    # read by the request handlers meanwhile
+    with open(os.path.join(target, 'verified.tmp'), 'w') as f:
+        f.write(verified.isoformat())
+    os.replace(os.path.join(target, 'verified.tmp'), os.path.join(target, 'verified'))
+    generations = sorted((os.path.getmtime(os.path.join(root, name)), name)
+                         for name in os.listdir(root) if not name.endswith('.tmp'))
+    os.utime(target)
+    for mtime, name in generations[:-KEEP_GENERATIONS]:
+        if name != generation:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return generation
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the published generations; `server.current` names the current one,
+    `server.secret` signs the manifest.
+    """
+    def do_GET(self):
+        root = self.server.root
+        generation = self.server.current
+        if generation is None:
+            self.send_error(503, "No vault index published yet")
+            return
+        if self.path == '/manifest.ini':
+            etag = '"' + generation + '"'
+            with open(os.path.join(root, generation, 'verified')) as f:
+                verified = f.read().strip()
+            fname = os.path.join(root, generation, 'manifest.ini')
+            with open(fname, 'rb') as f:
+                signed = signature(self.server.secret, f.read(), verified)
+            headers = {'ETag': etag, 'X-Labsync-Verified': verified,
+                       'X-Labsync-Signature': signed}
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+        else:
+            # nothing but a generation and an array name, no path of any kind
+            parts = self.path.split('/')
+            if (len(parts) != 3 or parts[0] or not GENERATION.fullmatch(parts[1]) or
+                    not INDEX_FILE.fullmatch(parts[2])):
+                self.send_error(404)
+                return
+            parts = parts[1:]
+            fname = os.path.join(root, parts[0], parts[1])
+            headers = {}
+        try:
+            f = open(fname, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, fi.DOWNLOAD_CHUNK)
+
+    def log_message(self, format, *args):
+        logger.info(self.address_string() + ' ' + format % args)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    An HTTP server with a thread per request (http.server has one from Python 3.7).
+    """
+    daemon_threads = True
+
+def make_server(root, secret, address=('', 8770)):
+    """
+    An HTTP server for the generations in `root`, not started yet.
+
+    Set its `current` attribute to a published generation; see `serve`.
+    """
+    server = ThreadingHTTPServer(address, ProxyHandler)
+    server.root = root
+    server.secret = secret
+    server.current = None
+    return server
+
+def serve(refresh, secret, address=('', 8770), interval=600, root=PUBLISHED):
+    """
+    Run the proxy: refresh and publish the binary index every `interval` seconds.
+
+    **Parameters**  
+    ---------------
+    refresh: callable  
+        *Brings a binary index up to date; returns its directory and when it was  
+        confirmed to match the vault. E.g. a wrapper of  
+        `labsync.sync.download_hash_list`, or a stand-in for testing.*  
+    secret: str  
+        *Shared with the workstations, to sign the manifest.*  
+    address: tuple  
+        *(host, port) to listen on.*  
+    interval: float  
+        *Seconds between refreshes.*  
+    root: str  
+        *Directory for the published generations.*  
+
+    **Notes**  
+    ---------
+    A failed refresh is logged and the previous generation stays available, with
+    its older confirmation time, so workstations can judge its age themselves.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    server = make_server(root, secret, address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Index proxy listening on " + str(server.server_address))
+    try:
+        while True:
+            try:
+                directory, verified = refresh()
+                server.current = publish(directory, root, verified)
+                logger.info("Published vault index generation " + server.current +
+                            ", confirmed at " + verified.isoformat())
+            except Exception as e:
+                logger.warning("Could not refresh the vault index: " + str(e))
+            time.sleep(interval)
+    finally:
+        server.shutdown()
+
+def fetch_binary_index(url, secret, directory=vi.INDEX_DIR, timeout=10):
+    """
+    Bring a local binary index up to date from an index proxy.
+
+    **Parameters**  
+    ---------------
+    url: str  
+        *Base URL of the proxy, e.g. 'http://labserver:8770/'.*  
+    secret: str  
+        *Shared with the proxy, to check the signature of the manifest.*  
+    directory: str  
+        *The local binary index directory.*  
+    timeout: float  
+        *Seconds to wait for the proxy.*  
+
+    **Returns**  
+    ------------
+    changed: bool  
+        *True if a new generation was downloaded.*  
+    verified: datetime  
+        *When the proxy last confirmed the index with the vault.*  
+
+    **Notes**  
+    ---------
+    Raises `requests.RequestException` when the proxy cannot be reached or answers
+    with an error, and ValueError when the signature or an array does not match;
+    the local copy is then left alone. A new generation is downloaded next to the
+    local copy and moved in place file by file, the manifest last, so a download
+    that breaks off leaves no current looking index.
+    """
+    url = url.rstrip('/')
+    manifest_file = os.path.join(directory, 'manifest.ini')
+    cache = fi.read_cache(manifest_file)
+    headers = {}
+    # only if the local index is still the one from the proxy, not rebuilt since
+    if ('etag' in cache and cache.get('remote') == url and
+            cache.get('manifest_sha256') == vi.file_sha256(manifest_file)):
+        headers['If-None-Match'] = cache['etag']
+    response = requests.get(url + '/manifest.ini', headers=headers, timeout=timeout)
+    response.raise_for_status()
+    if response.status_code == 304:
+        with open(manifest_file, 'rb') as f:
+            content = f.read()
+    else:
+        content = response.content
+    verified = response.headers['X-Labsync-Verified']
+    if not hmac.compare_digest(signature(secret, content, verified),
+                               response.headers.get('X-Labsync-Signature', '')):
+        raise ValueError("The index proxy at " + url + " sent a manifest with a wrong " +
+                         "signature; check [IndexProxy] secret.")
+    verified = fi.isotime(verified)
+    if response.status_code == 304:
+        return False, verified
+    etag = response.headers['ETag']
+    generation = etag.strip('"')
+    if not GENERATION.fullmatch(generation):
+        raise ValueError("The index proxy at " + url + " sent a malformed ETag.")
+    manifest = configparser.ConfigParser()
+    manifest.read_string(content.decode())
+    staging = directory + '.proxy'
+    if not os.path.isdir(staging):
+        os.makedirs(staging)
+    for name in index_files(manifest):
+        part = requests.get(url + '/' + generation + '/' + name, stream=True,
+                            timeout=timeout)
+        part.raise_for_status()
+        myhash = hashlib.sha256()
+        with open(os.path.join(staging, name), 'wb') as f:
+            for chunk in part.iter_content(fi.DOWNLOAD_CHUNK):
+                myhash.update(chunk)
+                f.write(chunk)
+        if myhash.hexdigest() != manifest.get('Files', name, fallback=None):
+            raise ValueError("The index proxy at " + url + " sent " + name +
+                             " that does not match its manifest.")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    for name in index_files(manifest):
+        os.replace(os.path.join(staging, name), os.path.join(directory, name))
+    with open(manifest_file + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    shutil.rmtree(staging, ignore_errors=True)
+    fi.write_cache(manifest_file, {'remote': url, 'etag': etag,
+                                   'manifest_sha256': vi.file_sha256(manifest_file),
+                                   'verified': verified.isoformat()})
+    logger.info("Downloaded vault index generation " + etag + " from the index proxy.")
+    return True, verified
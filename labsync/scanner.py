@@ -0,0 +1,108 @@
+import os
+import logging
+from collections import namedtuple
+import pkg_resources  # part of setuptools
+
+from labsync import checksum as cs
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Walk the data directory with `os.scandir`, one stat per file for the whole run.
+
+On data directories mounted over SMB every metadata call is a round trip. `scan`
+yields a `FileRecord` per data file with the size, mtime and inode of a single stat;
+hashing, the upload bookkeeping and the log lines of `labsync.sync` use that record
+instead of asking the file system again. The directory listing itself tells files
+from directories (no `isfile` per file on POSIX) and which files are sidecars.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.scanner")
+
+class FileRecord(namedtuple('FileRecord', ['path', 'size', 'mtime_ns', 'inode'])):
+    """
+    A data file as found by `scan`, with the stat result taken while scanning.
+    """
+    __slots__ = ()
+
+    @property
+    def fingerprint(self):
+        """
+        (size, mtime_ns, inode), as `labsync.checksum.fingerprint` makes it.
+        """
+        return (self.size, self.mtime_ns, self.inode)
+
+def record(path, info=None):
+    """
+    A `FileRecord` for a single file, e.g. one that was not scanned.
+
+    **Parameters**  
+    ---------------
+    path: str  
+        *File name.*  
+    info: object  
+        *An os.stat_result of the file, None to stat it.*  
+    """
+    if info is None:
+        info = os.stat(path)
+    return FileRecord(path, info.st_size, info.st_mtime_ns, info.st_ino)
+
+def _entry_record(entry):
+    info = entry.stat()
+    if not info.st_ino:
+        # the stat of a scandir entry has no inode on Windows
+        return record(entry.path)
+    return record(entry.path, info)
+
+def scan(top, skip=()):
+    """
+    Yield the data files below a directory, in a stable order.
+
+    **Parameters**  
+    ---------------
+    top: str  
+        *Directory to scan.*  
+    skip: iterable  
+        *File names to leave out, e.g. the local database.*  
+
+    **Yields**  
+    ----------
+    record: FileRecord  
+        *Per data file; files in sorted order, before the sorted subdirectories.*  
+
+    **Notes**  
+    ---------
+    Hidden files and directories, files ending in '~' and sidecar checksum files
+    (e.g. 'x.mat.sha256' next to 'x.mat', see `labsync.checksum.SIDECARS`) are left
+    out. Like `os.walk`, symbolic links to directories are not followed, and
+    directories that cannot be read are skipped (with a warning here). A file that
+    disappears between listing and stat is skipped too.
+    """
+    skip = set(skip)
+    try:
+        # read to the end, which closes the directory (no context manager before 3.6)
+        entries = [entry for entry in os.scandir(top) if not entry.name[0] == '.']
+    except OSError as e:
+        logger.warning("Could not scan " + top + ": " + str(e))
+        return
+    files = {}
+    dirs = []
+    for entry in entries:
+        try:
+            if entry.is_file():
+                files[entry.name] = entry
+            elif entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+        except OSError:
+            continue
+    for name in sorted(files):
+        if name.endswith('~') or name in skip:
+            continue
+        if any(name.endswith(ext) and name[:-len(ext)] in files for ext in cs.SIDECARS):
+            continue # checksums written by the experiment, never uploaded
+        try:
+            yield _entry_record(files[name])
+        except OSError:
+            continue
+    for entry in sorted(dirs, key=lambda entry: entry.name):
+        yield from scan(entry.path, skip)
@@ -0,0 +1,211 @@
+import os
+import time
+import random
+import logging
+import pkg_resources  # part of setuptools
+
+from labsync import checksum as cs
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Re-verification of cached digests: rate limited scrubbing, and the last check
+right before deletion.
+
+Files in the trash table are deleted on the strength of a digest that may have been
+reused from the digest catalog for many runs. The scrubber re-hashes a bounded slice
+of these files per run, at a limited number of bytes per second, so every file is
+verified again well before it is deleted without a full re-verification ever
+landing in one sync run.
+
+Files that were not verified since they entered the trash table come first, oldest
+entrance (closest to their deletion deadline) first; after that, the files with the
+oldest verification.
+
+Right before deletion, `verify_trashables` compares the stat fingerprint recorded in
+the trash table and only re-hashes files that changed, plus a random sample.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.scrub")
+
+class _Throttle(object):
+    """
+    Fake hash object that sleeps to keep the bytes fed to it under `rate` per second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.done = 0
+        self.start = time.monotonic()
+
+    def update(self, chunk):
+        self.done += len(chunk)
+        ahead = self.done / float(self.rate) - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def rehash(path, checksumtype, blocksize=cs.DEFAULT_BLOCKSIZE, throttle=None):
+    """
+    Hash a file again for the checksum type recorded in the trash table.
+
+    **Parameters**  
+    ---------------
+    path: str  
+        *File name.*  
+    checksumtype: str  
+        *A registered hashtype, e.g. 'sha2' or 'md5'.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+    throttle: object  
+        *Optional `_Throttle` to limit the read rate.*  
+
+    **Returns**  
+    ------------
+    str
+        *The hash string, encoded like in the vault index.*  
+    """
+    spec = cs.HASHTYPES[cs.hashtype_of(checksumtype)]
+    myhash = spec.constructor()
+    hashes = [myhash, throttle] if throttle else [myhash]
+    cs.feed_file(path, hashes, blocksize, 'readinto')
+    return spec.encode(myhash.digest())
+
+def scrub_candidates(mydb):
+    """
+    List trash table files that are still waiting for deletion, in scrub order.
+
+    **Parameters**  
+    ---------------
+    mydb: object  
+        *An instantiated `labsync.database.dbManager`.*  
+
+    **Returns**  
+    ------------
+    candidates: list  
+        *(path, checksum, checksum type, trash entrance timestamp) tuples.*  
+    """
+    cmd = ("SELECT trash_oripath, trash_checksum, trash_checksum_type, " +
+           "trash_timestamp_entrance, digest_verified FROM trash " +
+           "LEFT JOIN digest ON digest_full_path = trash_oripath " +
+           "WHERE trash_trashed_bool = 0")
+    mydb.cursor.execute(cmd)
+    rows = mydb.cursor.fetchall()
+    def order(row):
+        entrance, verified = row[3] or '', row[4] or ''
+        if verified < entrance:
+            return (0, entrance) # not verified since it was put in the trash table
+        return (1, verified)
+    rows.sort(key=order)
+    return [row[:4] for row in rows]
+
+def scrub(mydb, budget_bytes, rate=None, blocksize=cs.DEFAULT_BLOCKSIZE):
+    """
+    Re-hash a bounded slice of the files waiting in the trash table.
+
+    **Parameters**  
+    ---------------
+    mydb: object  
+        *An instantiated `labsync.database.dbManager`.*  
+    budget_bytes: int  
+        *Stop once this many bytes were hashed (the first file is always done).*  
+    rate: int  
+        *Maximum bytes per second, None for no limit.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+
+    **Returns**  
+    ------------
+    verified: list  
+        *Files that still have the checksum recorded in the trash table.*  
+    mismatches: list  
+        *Files that changed; their digest catalog entries and pending trash table  
+        rows are dropped, so the next classification starts from scratch.*
+    """
+    verified = []
+    mismatches = []
+    done = 0
+    throttle = _Throttle(rate) if rate else None
+    for path, checksum, checksumtype, entrance in scrub_candidates(mydb):
+        if done >= budget_bytes:
+            break
+        try:
+            size = os.stat(path).st_size
+            if done and done + size > budget_bytes:
+                continue # does not fit in this run, maybe a smaller one does
+            digest = rehash(path, checksumtype, blocksize, throttle)
+        except OSError:
+            continue # gone already, nothing left to verify
+        done += size
+        if digest == checksum:
+            verified.append(path)
+            mydb.verified_digest(path)
+        else:
+            logger.warning("Scrub: " + path + " no longer has checksum " + checksum +
+                           " that was recorded when it was put in the trash table.")
+            mismatches.append(path)
+    mydb.forget_digests(mismatches)
+    mydb.cursor.executemany("DELETE FROM trash WHERE trash_oripath = ? AND " +
+                            "trash_trashed_bool = 0;", [(path,) for path in mismatches])
+    mydb.commit()
+    logger.info("Scrub: verified " + str(len(verified)) + " files, " +
+                str(len(mismatches)) + " mismatches, " + str(done) + " bytes hashed.")
+    return verified, mismatches
+
+def verify_trashables(mydb, paths, sample=0.05, blocksize=cs.DEFAULT_BLOCKSIZE):
+    """
+    Check that files about to be deleted still have the checksum found in the vault.
+
+    The (size, mtime_ns, inode) fingerprint recorded in the trash table is compared
+    with the current one; only files with another (or no recorded) fingerprint are
+    re-hashed, plus a random `sample` fraction of the unchanged ones.
+
+    **Parameters**  
+    ---------------
+    mydb: object  
+        *An instantiated `labsync.database.dbManager`.*  
+    paths: list  
+        *Files (trash_oripath) about to be deleted.*  
+    sample: float  
+        *Fraction of unchanged files to re-hash anyway.*  
+    blocksize: int  
+        *Block size in Bytes.*  
+
+    **Returns**  
+    ------------
+    failed: list  
+        *Files that must not be deleted; their trash table rows are dropped, so the  
+        next run classifies them from scratch.*
+    """
+    failed = []
+    rehashed = 0
+    for path in paths:
+        mydb.cursor.execute("SELECT trash_checksum, trash_checksum_type, trash_size, " +
+                            "trash_mtime_ns, trash_inode FROM trash WHERE " +
+                            "trash_oripath = ? ORDER BY id DESC LIMIT 1", (path,))
+        row = mydb.cursor.fetchone()
+        if row is None:
+            continue
+        checksum, checksumtype, recorded = row[0], row[1], row[2:]
+        try:
+            current = cs.fingerprint(os.stat(path))
+        except OSError:
+            continue # gone already, nothing to delete
+        if current == tuple(recorded) and random.random() >= sample:
+            continue
+        rehashed += 1
+        try:
+            digest = rehash(path, checksumtype, blocksize)
+        except OSError as e:
+            logger.warning("Could not verify " + path + " before deletion: " + str(e))
+            failed.append(path)
+            continue
+        if digest != checksum:
+            logger.warning("Not deleting " + path + ": it no longer has checksum " +
+                           checksum + " that was found in the vault.")
+            failed.append(path)
+    mydb.forget_digests(failed)
+    mydb.cursor.executemany("DELETE FROM trash WHERE trash_oripath = ?;",
+                            [(path,) for path in failed])
+    mydb.commit()
+    logger.info("Verified " + str(len(paths)) + " files before deletion, re-hashed " +
+                str(rehashed) + ", " + str(len(failed)) + " failed.")
+    return failed
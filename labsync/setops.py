@@ -0,0 +1,116 @@
+import binascii
+import logging
+import numpy as np
+import pkg_resources  # part of setuptools
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Vectorized set operations on digest arrays.
+
+Local files are classified against the vault with a handful of numpy operations on
+fixed width digest arrays ('S16', 'S32', ...) instead of a Python loop per file:
+a binary search of all local digests in the sorted vault array at once. This
+scales to vault indexes with millions of entries.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.setops")
+
+def to_array(encoded, decode, width):
+    """
+    Decode hash strings to a fixed width array of raw digests.
+
+    **Parameters**  
+    ---------------
+    encoded: list  
+        *Hash strings, None for a missing digest.*  
+    decode: callable  
+        *Hash string to raw bytes, see `labsync.checksum.HASHTYPES`.*  
+    width: int  
+        *Digest size in bytes.*  
+
+    **Returns**  
+    ------------
+    digests: array-like  
+        *'S<width>' array, empty for missing or undecodable hash strings.*  
+    valid: array-like  
+        *Boolean array, False where the digest is missing or undecodable.*  
+    """
+    raws = []
+    valid = np.zeros(len(encoded), dtype=bool)
+    for i, string in enumerate(encoded):
+        raw = b''
+        if string is not None:
+            try:
+                raw = decode(string)
+            except (ValueError, binascii.Error):
+                raw = b''
+        if len(raw) == width:
+            valid[i] = True
+        else:
+            raw = b''
+        raws.append(raw)
+    return np.array(raws, dtype='S' + str(width)), valid
+
+def locate(local, vault, valid=None):
+    """
+    `member`, also returning the position of each found digest in `vault`.
+
+    **Returns**  
+    ------------
+    found: array-like  
+        *Boolean array aligned with `local`.*  
+    pos: array-like  
+        *Position of the first equal vault digest; meaningless where not found.*  
+    """
+    local = np.asarray(local)
+    if not len(local) or not len(vault):
+        return np.zeros(len(local), dtype=bool), np.zeros(len(local), dtype=int)
+    pos = np.searchsorted(vault, local)
+    pos[pos == len(vault)] = 0
+    found = np.asarray(vault[pos] == local)
+    if valid is not None:
+        found &= valid
+    return found, pos
+
+def member(local, vault, valid=None):
+    """
+    Check for every local digest if it is in the (sorted) vault digests.
+
+    **Parameters**  
+    ---------------
+    local: array-like  
+        *Local digests, any order, duplicates allowed.*  
+    vault: array-like  
+        *Vault digests, **sorted**, e.g. a memory mapped binary index array.*  
+    valid: array-like  
+        *Optional boolean mask; local digests where it is False never match.*  
+
+    **Returns**  
+    ------------
+    found: array-like  
+        *Boolean array aligned with `local`.*  
+    """
+    return locate(local, vault, valid)[0]
+
+def first_hits(found):
+    """
+    The first column that matched, per file.
+
+    **Parameters**  
+    ---------------
+    found: list  
+        *Boolean arrays of equal length, one per hashtype in order of preference.*  
+
+    **Returns**  
+    ------------
+    hit: array-like  
+        *Integer array: the position in `found` of the first True per file, -1 when  
+        no column matched.*
+    """
+    if not found:
+        return np.zeros(0, dtype=int)
+    stacked = np.vstack(found)
+    hit = np.argmax(stacked, axis=0)
+    hit[~stacked.any(axis=0)] = -1
+    return hit
@@ -48,6 +48,7 @@ import logging.handlers  # for rotating logs
 import ntpath
 import os
 import posixpath
+import queue
 import random
 import re
 import shutil
@@ -55,6 +56,8 @@ import socket
 import sys
 import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import easywebdav as dav
 import numpy as np
@@ -62,6 +65,12 @@ import numpy as np
 import pkg_resources  # part of setuptools
 from labsync import checksum as cs
 from labsync import database as db
+from labsync import indexfetch as fi
+from labsync import indexproxy as ip
+from labsync import scanner as sn
+from labsync import scrub as sc
+from labsync import setops as so
+from labsync import vaultindex as vi
 # our own modules
 from labsync import settings
 from labsync import yoda_helpers as yh
@@ -376,9 +385,10 @@ def connect(config):
         return wbdv
 
 
-def download_hash_list(config, config_filename, server):
+def download_hash_list(config, config_filename, server, use_proxy=True):
     """
-    Download file with indexes of files found in vault and return lists.
+    Download the file(s) with indexes of files found in the vault(s) (when they
+    changed) and open them as one binary index.
     
     **Parameters**
     --------------
@@ -388,173 +398,692 @@ def download_hash_list(config, config_filename, server):
         *Path to config file.*  
     server: Object  
         *Easywebdav instantiated class object.*  
+    use_proxy: bool  
+        *If False, never ask the [IndexProxy] (the proxy itself uses this).*  
     
     **Returns**
     -----------
-    download_list: list  
-        *A list of vault files/indices as downloaded from YODA.*  
-    md5_list: list  
-        *Sub list from the index files that have been checksummed with 
-        MD5 algorithm.*  
-    sha256_list list: list  
-        *Sub list from the index files that have been checksummed with 
-        SHA256 algorithm.*  
+    vault: object  
+        *A `labsync.vaultindex.BinaryVaultIndex`; the text indexes are only parsed  
+        again when one of them changed.*  
+    verified: datetime  
+        *When the index was last confirmed to match the vaults (the oldest  
+        confirmation of all index files). If the server cannot be reached the  
+        previous copy is used, with its older confirmation time.*  
+
+    **Notes**  
+    ---------
+    The index files listed by `index_sources` are downloaded concurrently, over the
+    same connection pool. With an [IndexProxy] 'url' the binary index is taken from
+    the index proxy on the lab network instead, see `labsync.indexproxy`; the vault
+    is only asked when the proxy cannot be reached, its copy is older than
+    'max_age_hours' or does not match the [IndexProxy] 'secret'.
     """
-    config.read(config_filename)
     save_loc = '.'
-    checksum_file = config.get('CHECKSUM_PATH', 'checksum_file')
-    # remote pathnames always posix.
-    remote_checksumfile = checksum_file
-    local_checksumfile = os.path.join(save_loc, 'checksums.txt')
-    # local can be 'nt' or 'posix', let's normalise stuff
-    if myos == 'nt':
-        local_checksumfile = ntpath.normpath(local_checksumfile)
-    server.download(remote_checksumfile, local_checksumfile)
-    with open(local_checksumfile, 'r') as curr_file:
-        download_list = curr_file.readlines()
-    download_list = [i.split() for i in download_list if not i[0] == '#']
-    md5_list = [i for i in download_list if 'md' in i[0]]
-    sha256_list = [i for i in download_list if 'sha' in i[0]]
-    return download_list, md5_list, sha256_list
+    sources = index_sources(config)
+    reuse_seconds, max_age, incremental = index_cache_settings(config)
+    memory_bytes = compare_memory(config)
+    url, timeout, secret = index_proxy_settings(config)
+    if url and not secret:
+        logger.warning("No [IndexProxy] secret configured, not using the index proxy.")
+    if url and secret and use_proxy:
+        index_dir = os.path.join(save_loc, vi.INDEX_DIR)
+        try:
+            changed, verified = ip.fetch_binary_index(url, secret, index_dir, timeout)
+            if dt.datetime.now() - verified <= max_age:
+                return vi.BinaryVaultIndex(index_dir, memory_bytes), verified
+            logger.warning("The index proxy has a vault index confirmed at " +
+                           verified.isoformat() + ", asking the vault instead.")
+        except Exception as e:
+            logger.warning("Could not use the index proxy at " + url +
+                           ", asking the vault instead: " + str(e))
+    def fetch(source):
+        vault_name, remote_checksumfile, local_checksumfile = source
+        try:
+            return fi.fetch_index(server, remote_checksumfile, local_checksumfile,
+                                  reuse_seconds, incremental)
+        except Exception as e:
+            verified = fi.verified_at(local_checksumfile)
+            if verified is None:
+                raise
+            logger.warning("Could not download the vault index " + remote_checksumfile +
+                           ", using the copy confirmed at " + verified.isoformat() +
+                           ": " + str(e))
+            return False, verified
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        fetched = list(pool.map(fetch, sources))
+    changed = any(result[0] for result in fetched)
+    verified = min(result[1] for result in fetched)
+    vault = vi.open_index([(source[0], source[2]) for source in sources],
+                          os.path.join(save_loc, vi.INDEX_DIR),
+                          unchanged=not changed, memory_bytes=memory_bytes)
+    return vault, verified
+
+
+def index_sources(config):
+    """
+    The vault index files to download.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    sources: list  
+        *(vault, remote path, local path) tuples. Without a [Vaults] section this  
+        is the [CHECKSUM_PATH] 'checksum_file', saved as 'checksums.txt' (its  
+        shards under their own file names). Every [Vaults] option names a vault and  
+        gives the path of its index file, saved as '<vault>_<file name>'.*  
 
+    **Notes**  
+    ---------
+    A vault index that is split into shards is configured with placeholders in its
+    path: '{lab_id}' and '{box_id}' are filled in from [LocalID], so only the shard
+    of this workstation is downloaded, and '{hashtype}' gives one shard per
+    registered hashtype. Without a [Vaults] section the vault is named after the
+    file with '{hashtype}' left out, e.g. 'checksums-lab1' for
+    '/grp/checksums-{lab_id}-{hashtype}.txt'.
+    """
+    save_loc = '.'
+    placeholders = {}
+    for option in ('lab_id', 'box_id'):
+        if config.has_option('LocalID', option):
+            placeholders['{' + option + '}'] = config.get('LocalID', option)
+    def expand(template):
+        for key, value in placeholders.items():
+            template = template.replace(key, value)
+        return template
+    if config.has_section('Vaults'):
+        vaults = [(name, expand(remote), None) for name, remote in config.items('Vaults')]
+    else:
+        remote = expand(config.get('CHECKSUM_PATH', 'checksum_file'))
+        name = vi.vault_name(re.sub(r'[-_.]?\{hashtype\}', '', remote))
+        vaults = [(name, remote, 'checksums.txt')]
+    sources = []
+    for name, template, local_name in vaults:
+        if '{hashtype}' in template:
+            remotes = [template.replace('{hashtype}', hashtype)
+                       for hashtype in cs.HASHTYPES]
+        else:
+            remotes = [template]
+        # remote pathnames always posix.
+        for remote_checksumfile in remotes:
+            if local_name and len(remotes) > 1:
+                # one shard per hashtype, each needs a local copy of its own
+                local_checksumfile = os.path.join(
+                    save_loc, posixpath.basename(remote_checksumfile))
+            elif local_name:
+                local_checksumfile = os.path.join(save_loc, local_name)
+                # kept compressed, decompressed while parsing
+                for ext in fi.COMPRESSED:
+                    if remote_checksumfile.endswith(ext):
+                        local_checksumfile += ext
+            else:
+                local_checksumfile = os.path.join(
+                    save_loc, name + '_' + posixpath.basename(remote_checksumfile))
+            # local can be 'nt' or 'posix', let's normalise stuff
+            if myos == 'nt':
+                local_checksumfile = ntpath.normpath(local_checksumfile)
+            sources.append((name, remote_checksumfile, local_checksumfile))
+    return sources
+
+
+LocalScan = namedtuple('LocalScan', ['source_path', 'entries', 'deferred', 'catalog'])
+"""
+Result of `scan_local`: the data directory, a [path, fingerprint, digests, cached
+digests] list per file, the paths deferred to the next run and the digest catalog.
+"""
 
-def comp2localchecksum(config, config_filename, md_list, sha_list, testing):
+
+def scan_local(config, testing):
     """
-    Creates indexfile list of local files.
+    Walk the data directory and compute the primary digest of every file.
     
     **Parameters**
+    --------------
+    config: Object  
+        *Configparser object, already read.*  
+    testing: bool  
+        *If True, uses the test_data_dir.*  
+    
+    **Returns**
+    -----------
+    scan: LocalScan  
+        *To be classified against the vault index by `comp2localchecksum`.*  
+
+    **Notes**  
+    ---------
+    The data directory is walked by `labsync.scanner.scan`, one stat per file. Needs
+    neither the server nor the vault index, so it can run while the index is
+    downloaded. It opens its own database connection and stores nothing, so it can
+    run in a thread of its own. Other hashtypes than the primary one depend on the
+    vault index and are computed by `comp2localchecksum`.
+    """
+    primary = cs.PRIMARY
+    source_path = config.get('LocalFolders', 'data_dir')
+    if testing:
+        source_path = config.get('TEST_DATA_DIR', 'test_data_dir')
+    upload_db = config.get('LocalDataBase', 'database')
+    # digests of files that did not change since the previous run are reused; a
+    # connection of its own, this may run in another thread than the classification
+    mydb = db.dbManager(upload_db, debug=DEBUGDB)
+    catalog = mydb.load_digests()
+    workers = hash_workers(config)
+    blocksize, method = hash_blocksize(config)
+    quiet_ns = stable_seconds(config) * 1e9
+    walk_ns = time.time() * 1e9
+    entries = []
+    deferred = []
+    if myos not in ('nt', 'posix'):
+        print("What OS are you on?, this support windows, MacOSX and Linux/Unix")
+        raise OSError
+    # sorted scan, so the upload/delete lists come out the same every run; the
+    # fingerprint of the scan is used for the rest of the run, no file is stat-ed again
+    for record in sn.scan(source_path, skip=(os.path.basename(upload_db),)):
+        file_path, fp = record.path, record.fingerprint
+        if walk_ns - fp[1] < quiet_ns:
+            deferred.append(file_path) # probably still being written
+            continue
+        digests = {}
+        if file_path in catalog and catalog[file_path][0] == fp:
+            digests = catalog[file_path][1]
+        entries.append([file_path, fp, dict(digests), digests])
+    # sidecar checksum files can spare the read altogether
+    trust, verify, sample = sidecar_policy(config)
+    sidecar_checks = []
+    for e in entries if trust else ():
+        if primary in e[2]:
+            continue
+        digests = cs.by_hashtype(cs.read_sidecars(e[0], e[1][1]))
+        if primary not in digests:
+            continue # the file has to be read anyway
+        if verify == 'always' or (verify == 'sampled' and random.random() < sample):
+            sidecar_checks.append((e, digests))
+        else:
+            e[2] = dict(digests, **e[2])
+    todo = [e for e in entries if primary not in e[2]]
+    results = cs.hash_files([(e[0], e[1]) for e in todo],
+                            (cs.HASHTYPES[primary].algoID,),
+                            workers=workers, blocksize=blocksize, method=method)
+    for e, digests in zip(todo, results):
+        if digests:
+            e[2].update(cs.by_hashtype(digests))
+    for e, digests in sidecar_checks:
+        if primary in e[2] and digests[primary] != e[2][primary]:
+            logger.warning("Sidecar checksum does not match the data file, using the " +
+                           "computed checksum for " + e[0])
+    return LocalScan(source_path, entries, deferred, catalog)
+
+
+def comp2localchecksum(config, config_filename, vault, testing, scan=None):
+    """
+    Creates indexfile list of local files.
+    
+    **Parameters**  
     ----------
     config: Object  
         *Configparser object.*  
     config_filename: str  
         *Path to config file.*  
-    md_list: list  
-        *List with md5 checksums.*   
-    sha_list: list  
-        *List with sha256 checksums.*  
+    vault: object  
+        *The vault index as returned by `download_hash_list`.*  
+    scan: LocalScan  
+        *The local files as found by `scan_local`; scanned here when not given.*  
     
-    **Returns**
+    **Returns**  
     -------
     files2delete: list  
         *List of files to upload.*  
     files2upload: list  
         *List of files marked for deletion.*  
-    
+
+    Both as (path, checksum, checksumtype, fingerprint) tuples, the fingerprint  
+    (size, mtime_ns, inode) taken by the scan.  
+
+    **Notes**  
+    ---------
+    Digests are kept in the 'digest' table of the local database, keyed by the
+    (path, size, mtime_ns, inode) fingerprint. A file is only hashed again when its
+    fingerprint changed. Files with a size that does not occur in the vault index are
+    marked for upload without comparing checksums. Besides sha2 (computed by
+    `scan_local`), a hashtype is only computed for files with a size that occurs
+    among its entries, and not at all once a cached digest matches. The outcome is
+    kept per file in the 'vault_status' table; unchanged files are only looked up
+    again when one of their digests was added to or removed from the vault since.
+    Files modified within the [Stability] quiet period, or that change while being
+    hashed, are deferred to the next run (neither uploaded nor deleted). Sidecar
+    checksum files ('<file>.sha256', '<file>.md5') are never uploaded; when the
+    [Sidecars] section allows it, their digests are used instead of reading the data
+    file.
+
     **See Also**  
     ------------
-    `labsync.checksum.make_hash_string`
+    `labsync.checksum.chunk_multi`, `scan_local`
     """
     files2upload = []
     files2delete = []
-    md_checksums = [i[1] for i in md_list]
-    sha_checksums = [i[1] for i in sha_list]
-    config.read(config_filename)
-    source_path = config.get('LocalFolders', 'data_dir')
-    if testing:
-        source_path = config.get('TEST_DATA_DIR', 'test_data_dir')
+    primary = cs.PRIMARY
+    if scan is None:
+        scan = scan_local(config, testing)
+    source_path, entries, deferred, catalog = scan
+    deferred = list(deferred)
     upload_db = config.get('LocalDataBase', 'database')
-    hash_list = []
-    for (dirpath, dirnames, filenames) in os.walk(source_path):
-        if myos == 'nt':
-            filenames = [f for f in filenames if not f[0] == '.' and not
-            str(f) == ntpath.basename(upload_db)]
-        elif myos == 'posix':
-            filenames = [f for f in filenames if not f[0] == '.' and not
-            str(f) == posixpath.basename(upload_db)]
+    mydb = db.dbManager(upload_db, debug=DEBUGDB)
+    workers = hash_workers(config)
+    blocksize, method = hash_blocksize(config)
+    # a size that is not in the index cannot be in the vault, so the file is
+    # uploaded and only needs the primary digest for the upload bookkeeping; other
+    # hashtypes are only worth computing for sizes that occur among their entries
+    sizes = np.array([e[1][0] for e in entries], dtype='<i8')
+    wanted = [set([primary]) for e in entries]
+    in_index = np.zeros(len(entries), dtype=bool)
+    for hashtype in cs.HASHTYPES:
+        has = vault.has_sizes(hashtype, sizes)
+        in_index |= has
+        for i in np.flatnonzero(has):
+            wanted[i].add(hashtype)
+    def missing(e, want, hit=None):
+        # hashtypes that still have to be computed before the file can be classified
+        if primary in e[2] and hit:
+            return set()
+        return want - set(e[2])
+    # unchanged files keep the vault status of the previous run: as it is when the
+    # vault index did not change, otherwise unless one of their digests was added
+    # to or removed from the vault since
+    statuses = mydb.load_vault_status() if vault.source else {}
+    known = np.zeros(len(entries), dtype=bool)
+    behind = []
+    for i, (e, want) in enumerate(zip(entries, wanted)):
+        status = statuses.get(e[0])
+        if (status is None or status[0] != e[1] or not e[3] or
+                missing(e, want, status[1] or None)):
+            continue
+        if status[2] == vault.source:
+            known[i] = True
+        elif vault.previous and status[2] == vault.previous:
+            known[i] = True
+            behind.append(i)
+    behind = np.array(behind, dtype=int)
+    for hashtype in cs.HASHTYPES:
+        changed = vault.changed_many(hashtype, [entries[i][2].get(hashtype) for i in behind])
+        known[behind[changed]] = False
+    def vault_hits():
+        # per entry the first hashtype (in order of preference) found in the vault,
+        # looked up for the entries without a known status only
+        hits = [statuses[e[0]][1] or None if k else None for e, k in zip(entries, known)]
+        todo = np.flatnonzero(~known)
+        found = [vault.contains_many(hashtype, [entries[i][2].get(hashtype) for i in todo])
+                 for hashtype in cs.HASHTYPES]
+        for i, h in zip(todo, so.first_hits(found)):
+            hits[i] = list(cs.HASHTYPES)[h] if h >= 0 else None
+        return hits
+    # one read per file for all missing digests, grouped by the set of hashtypes
+    groups = {}
+    for e, want, hit in zip(entries, wanted, vault_hits()):
+        todo = missing(e, want, hit)
+        if todo:
+            groups.setdefault(tuple(h for h in cs.HASHTYPES if h in todo), []).append(e)
+    for hashtypes, todo in groups.items():
+        algoIDs = tuple(cs.HASHTYPES[h].algoID for h in hashtypes)
+        results = cs.hash_files([(e[0], e[1]) for e in todo], algoIDs,
+                                workers=workers, blocksize=blocksize, method=method)
+        for e, digests in zip(todo, results):
+            if digests:
+                e[2].update(cs.by_hashtype(digests))
+    seen = set()
+    fresh_digests = []
+    fresh_status = []
+    for e, want, hit, sized, k in zip(entries, wanted, vault_hits(), in_index, known):
+        file_path, fp, digests, cached = e
+        if missing(e, want, hit):
+            deferred.append(file_path) # unreadable or changed, left for the next run
+            continue
+        seen.add(file_path)
+        if not sized or not hit:
+            files2upload.append((file_path, digests[primary], primary, fp))
         else:
-            print("What OS are you on?, this support windows, MacOSX and Linux/Unix")
-            raise OSError
-        dirnames[:] = [d for d in dirnames if not d[0] == '.']  # skip hidden .DS_Store etc.
-        for file in filenames:
-            if myos == 'nt':
-                file_path = ntpath.join(dirpath, file)
-            elif myos == 'posix':
-                file_path = posixpath.join(dirpath, file)
-            else:
-                print("What OS are you on?, support for windows, MacOSX and Linux/Unix")
-                raise OSError
-            if os.path.isfile(file_path) and not file_path.endswith('~'):
-                hash_str1 = cs.make_hash_string(file_path, 'SHA256')
-                hash_str1 = hash_str1.split()
-                if hash_str1[1] in sha_checksums:
-                    files2delete.append((file_path, hash_str1[1], 'sha2'))
-                else:
-                    hash_str2 = cs.make_hash_string(file_path, 'MD5')
-                    hash_str2 = hash_str2.split()
-                    if hash_str2[1] in md_checksums:
-                        files2delete.append((file_path, hash_str2[1], 'md5'))
-                    else:
-                        files2upload.append((file_path, hash_str1[1], 'sha2'))
+            files2delete.append((file_path, digests[hit], hit, fp))
+        if digests != cached:
+            fresh_digests.append((file_path, fp, digests))
+        if not k:
+            fresh_status.append((file_path, fp, hit or '', digests))
+    reused = len(seen) - len(fresh_digests)
+    unclassified = [path for path in statuses if path not in seen and
+                    path.startswith(source_path)]
+    seen.update(deferred)
+    if deferred:
+        logger.info("Deferred " + str(len(deferred)) + " files that are still being " +
+                    "written or could not be read to the next run.")
+    gone = [path for path in catalog if path not in seen and
+            path.startswith(source_path)]
+    # which vault the files to delete were found in
+    origins = dict((path, status[3]) for path, status in statuses.items())
+    for hashtype in cs.HASHTYPES:
+        found = [row for row in fresh_status if row[2] == hashtype]
+        names = vault.vaults_many(hashtype, [row[3][hashtype] for row in found])
+        origins.update((row[0], name or '') for row, name in zip(found, names))
+    per_vault = {}
+    for file_path, checksum, checksumtype, fp in files2delete:
+        name = origins.get(file_path) or 'unknown'
+        per_vault[name] = per_vault.get(name, 0) + 1
+    mydb.store_digests(fresh_digests)
+    mydb.forget_digests(gone)
+    if vault.source:
+        if vault.previous:
+            mydb.advance_vault_status([entries[i][0] for i in behind if known[i]],
+                                      vault.previous, vault.source)
+        mydb.store_vault_status([(path, fp, hit, origins.get(path, ''))
+                                 for path, fp, hit, digests in fresh_status], vault.source)
+        mydb.forget_vault_status(unclassified)
+    mydb.commit()
+    logger.info("Hashed " + str(len(fresh_digests)) + " new or changed files, reused " +
+                "cached digests for " + str(reused) + " files.")
+    logger.info("Looked up " + str(len(fresh_status)) + " files in the vault index, " +
+                "kept the vault status of " + str(int(known.sum())) + " files.")
+    if per_vault:
+        logger.info("Files found in the vault, per vault: " + str(per_vault))
     return files2upload, files2delete
 
 
-def sort_list(hash_list):
+def hash_workers(config):
     """
-    Sort list made from index files based upon hash keys.
+    Number of hashing threads as configured.
     
-    **Parameters**
+    **Parameters**  
     --------------
-    hash_list: list  
-        *Indexfile as list.*  
+    config: Object  
+        *Configparser object.*  
     
-    **Returns**
+    **Returns**  
     -----------
-    hash_list  
-        *The **sorted** list*  
+    workers: int  
+        *The [Hashing] 'workers' option, `labsync.checksum.default_workers` when it  
+        is missing or set to 'auto'.*  
     """
-    hash_list.sort(key=lambda x: x[1])  # sort list based on hashkeys (at pos 1)
-    return hash_list
+    if config.has_option('Hashing', 'workers'):
+        workers = config.get('Hashing', 'workers').strip().lower()
+        if workers and workers != 'auto':
+            return max(1, int(workers))
+    return cs.default_workers()
 
 
-def compare(local_list, vault_list):
+def stable_seconds(config):
     """
-    Compare two lists based on hash keys.
+    How long a file must be left alone before it is hashed and uploaded.
     
-    **Parameters**
+    **Parameters**  
     --------------
-    local_list: list  
-        *List of files from workstation (local).*  
-    vault_list: list  
-        *List of files from vault (remote)*  
+    config: Object  
+        *Configparser object.*  
     
-    **Returns**
+    **Returns**  
     -----------
-    files2delete: list  
-        *List with files marked for deletion from local workstation (lab computer).*  
-    files2upload: list      
-        *List with files marked for uploading to intake.*  
+    seconds: float  
+        *The [Stability] 'quiet_seconds' option, 120 when missing. Files modified  
+        more recently are deferred to the next run.*  
     """
-    temp_vault_list = vault_list
-    temp_local_list = local_list
-    files2upload = []
-    files2delete = []
-    for local_file in temp_local_list:
-        local_hash = local_file[1]
-        if temp_vault_list:
-            for remote_file in temp_vault_list:
-                remote_hash = remote_file[1]
-                if local_hash == remote_hash:
-                    files2delete.append(local_file[3])
-                    del temp_vault_list[0]
-                    break
-                elif local_hash > remote_hash:
-                    for counter, remote_file in enumerate(temp_vault_list):
-                        remote_hash = remote_file[1]
-                        if local_hash == remote_hash:
-                            files2delete.append(local_file[3])
-                            del temp_vault_list[0:counter + 1]
-                            break
-                        elif local_hash < remote_hash:
-                            files2upload.append(local_file[3])
-                            del temp_vault_list[0:counter]
-                            break
-                    break
-                elif local_hash < remote_hash:
-                    files2upload.append(local_file[3])
-                    break
-        else:
-            files2upload.append(local_file[3])
-    return files2delete, files2upload
+    if config.has_option('Stability', 'quiet_seconds'):
+        return config.getfloat('Stability', 'quiet_seconds')
+    return 120.0
+
+
+def sidecar_policy(config):
+    """
+    How to treat sidecar checksum files written by the experiment software.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    trust: bool  
+        *The [Sidecars] 'trust' option, False when missing.*  
+    verify: str  
+        *The [Sidecars] 'verify' option: 'never', 'sampled' or 'always' (default),  
+        whether a trusted sidecar is checked by hashing the data file anyway.*  
+    sample: float  
+        *The [Sidecars] 'sample' option, fraction of sidecars checked when verify  
+        is 'sampled', 0.05 when missing.*  
+    """
+    trust = False
+    verify = 'always'
+    sample = 0.05
+    if config.has_option('Sidecars', 'trust'):
+        trust = config.getboolean('Sidecars', 'trust')
+    if config.has_option('Sidecars', 'verify'):
+        verify = config.get('Sidecars', 'verify').strip().lower()
+    if config.has_option('Sidecars', 'sample'):
+        sample = config.getfloat('Sidecars', 'sample')
+    if verify not in ('never', 'sampled', 'always'):
+        logger.critical("[Sidecars] verify must be 'never', 'sampled' or 'always'.")
+        raise ValueError("[Sidecars] verify must be 'never', 'sampled' or 'always'.")
+    return trust, verify, sample
+
+
+def hash_blocksize(config):
+    """
+    Hashing block size and read method as configured.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    blocksize: int  
+        *The [Hashing] 'blocksize' option in bytes; when it is missing or 'auto' the  
+        block size autotuned for this machine, see `labsync.checksum.tuned_blocksize`  
+        (no tuning where `hashlib.file_digest` reads the files).*  
+    method: str  
+        *The [Hashing] 'method' option, 'auto' when missing.*  
+    """
+    blocksize = 'auto'
+    method = 'auto'
+    if config.has_option('Hashing', 'blocksize'):
+        blocksize = config.get('Hashing', 'blocksize').strip().lower() or 'auto'
+    if config.has_option('Hashing', 'method'):
+        method = config.get('Hashing', 'method').strip().lower() or 'auto'
+    if blocksize == 'auto':
+        blocksize = cs.tuned_blocksize()
+    return int(blocksize), method
+
+
+def verify_sample(config):
+    """
+    Fraction of unchanged files that is re-hashed anyway right before deletion.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    sample: float  
+        *The [Deletion] 'verify_sample' option, 0.05 when missing.*  
+    """
+    if config.has_option('Deletion', 'verify_sample'):
+        return config.getfloat('Deletion', 'verify_sample')
+    return 0.05
+
+
+def index_cache_settings(config):
+    """
+    How long a downloaded vault index may be used.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    reuse_seconds: float  
+        *The [IndexCache] 'reuse_minutes' option in seconds: within this time after  
+        the last download the server is not asked again. 0 when missing.*  
+    max_age: timedelta  
+        *The [IndexCache] 'max_age_hours' option: no deletions are decided on an  
+        index that was not confirmed within this time. 24 hours when missing.*  
+    incremental: bool  
+        *The [IndexCache] 'incremental' option: only fetch what was appended to the  
+        index since the previous download. False when missing.*  
+    """
+    reuse_minutes = 0
+    max_age_hours = 24
+    incremental = False
+    if config.has_option('IndexCache', 'reuse_minutes'):
+        reuse_minutes = config.getfloat('IndexCache', 'reuse_minutes')
+    if config.has_option('IndexCache', 'max_age_hours'):
+        max_age_hours = config.getfloat('IndexCache', 'max_age_hours')
+    if config.has_option('IndexCache', 'incremental'):
+        incremental = config.getboolean('IndexCache', 'incremental')
+    # a reused index must still be fresh enough for deletions
+    reuse_seconds = min(reuse_minutes * 60, max_age_hours * 3600)
+    return reuse_seconds, dt.timedelta(hours=max_age_hours), incremental
+
+
+def compare_memory(config):
+    """
+    Memory ceiling for building and comparing against the vault index.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    memory_bytes: int  
+        *The [Compare] 'memory_mb' option in bytes; None when missing or 0, in which  
+        case the index is sorted and searched in memory.*  
+    """
+    if config.has_option('Compare', 'memory_mb'):
+        memory_mb = config.getfloat('Compare', 'memory_mb')
+        if memory_mb > 0:
+            return int(memory_mb * 1048576)
+    return None
+
+
+def index_proxy_settings(config):
+    """
+    Where to find the index proxy on the lab network.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    
+    **Returns**  
+    -----------
+    url: str  
+        *The [IndexProxy] 'url' option; None when missing or empty, in which case  
+        the vault index is downloaded from the vault directly.*  
+    timeout: float  
+        *The [IndexProxy] 'timeout' option in seconds, 10 when missing.*  
+    secret: str  
+        *The [IndexProxy] 'secret' option, shared by the proxy and the workstations  
+        to sign the index; None when missing or empty, in which case the proxy is  
+        not used.*  
+    """
+    url = None
+    timeout = 10
+    secret = None
+    if config.has_option('IndexProxy', 'url'):
+        url = config.get('IndexProxy', 'url').strip() or None
+    if config.has_option('IndexProxy', 'timeout'):
+        timeout = config.getfloat('IndexProxy', 'timeout')
+    if config.has_option('IndexProxy', 'secret'):
+        secret = config.get('IndexProxy', 'secret').strip() or None
+    return url, timeout, secret
+
+
+def scrub_settings(config, idle=False):
+    """
+    Byte budget and rate for scrubbing cached digests.
+    
+    **Parameters**  
+    --------------
+    config: Object  
+        *Configparser object.*  
+    idle: bool  
+        *If True, the budget for a scrub-only run, see `scrub_main`.*  
+    
+    **Returns**  
+    -----------
+    budget: int  
+        *The [Scrub] 'budget_mb' (or 'idle_budget_mb') option in bytes; 512 MB per  
+        sync run and 4096 MB per idle run when missing.*  
+    rate: int  
+        *The [Scrub] 'rate_mb' option in bytes per second, 64 MB/s when missing.*  
+    """
+    option, budget_mb = ('idle_budget_mb', 4096) if idle else ('budget_mb', 512)
+    rate_mb = 64
+    if config.has_option('Scrub', option):
+        budget_mb = config.getfloat('Scrub', option)
+    if config.has_option('Scrub', 'rate_mb'):
+        rate_mb = config.getfloat('Scrub', 'rate_mb')
+    return int(budget_mb * 1048576), int(rate_mb * 1048576) or None
+
+
+def scrub_main():
+    """
+    Scrub-only run, e.g. scheduled while the workstation is idle.
+    
+    Re-verifies the cached digests of files waiting in the trash table within the
+    [Scrub] 'idle_budget_mb' budget. No login is needed.
+    
+    **Returns**  
+    -----------
+    verified: list  
+        *Files that still have their recorded checksum.*  
+    mismatches: list  
+        *Files that changed since they were put in the trash table.*  
+    """
+    config = configparser.RawConfigParser()
+    config_filename = getConfigFile()
+    config.read(config_filename)
+    database_filename = config["LocalDataBase"]["database"]
+    if not os.path.isfile(database_filename):
+        db.build_db(database_filename)
+    else:
+        db.upgrade_db(database_filename)
+    budget, rate = scrub_settings(config, idle=True)
+    mydb = db.dbManager(database_filename, debug=DEBUGDB)
+    return sc.scrub(mydb, budget, rate)
+
+
+def proxy_main():
+    """
+    Run the index proxy for the lab network, see `labsync.indexproxy`.
+    
+    Logs in once, then refreshes the vault index every [IndexProxy]
+    'refresh_minutes' (10 when missing) and serves it on [IndexProxy] 'listen'
+    (host:port, 0.0.0.0:8770 when missing) until it is stopped.
+    """
+    config = configparser.RawConfigParser()
+    config_filename = getConfigFile()
+    config.read(config_filename)
+    listen = '0.0.0.0:8770'
+    refresh_minutes = 10
+    if config.has_option('IndexProxy', 'listen'):
+        listen = config.get('IndexProxy', 'listen')
+    if config.has_option('IndexProxy', 'refresh_minutes'):
+        refresh_minutes = config.getfloat('IndexProxy', 'refresh_minutes')
+    host, port = listen.rsplit(':', 1)
+    url, timeout, secret = index_proxy_settings(config)
+    if not secret:
+        logger.critical("The index proxy needs an [IndexProxy] secret.")
+        raise ValueError("The index proxy needs an [IndexProxy] secret.")
+    wbdv = connect(config)
+    def refresh():
+        vault, verified = download_hash_list(config, config_filename, wbdv, use_proxy=False)
+        return vault.directory, verified
+    ip.serve(refresh, secret, (host, int(port)), refresh_minutes * 60)
 
 
 def bytesto(bytes_in, to, bsize=1024):
@@ -640,7 +1169,9 @@ def sync(server, config, files2upload, files2delete, reupload_delta,
     files2upload: list  
         *A list of files that are not found in the vault.*  
     files2delete: list  
-        *A list of files that are found in the vault.*  
+        *A list of files that are found in the vault. Both lists as returned by  
+        `comp2localchecksum`; file sizes are taken from the fingerprints in there,  
+        not from the file system.*  
     reupload_delta: object  
         *Datetime delta object that controls when to reupload locally 
         'know files' or not.*  
@@ -678,6 +1209,9 @@ def sync(server, config, files2upload, files2delete, reupload_delta,
         *Warnings(type 1)*  
     warnlist2: list  
         *Warnings(type 2)*  
+    warnlist3: list  
+        *Files not deleted because they changed after they were found in the vault  
+        (warnings of type 4).*  
     dberror: boolean  
         *If any db errors were encounterd: True, else: False.*  
     """
@@ -761,7 +1295,7 @@ or lab technician.""")
     done_before = []
     # check each file first time
     try:
-        for file, checksum, checksumtype in files2upload:
+        for file, checksum, checksumtype, fp in files2upload:
             if myos == 'nt':
                 file = ntpath.normpath(file)
             if myos == 'posix':
@@ -781,7 +1315,7 @@ or lab technician.""")
             rel_path = posixpath.normpath(posixpath.join(remote_path, filename))
             if not file in uploaded:
                 logger.info("New file to upload: " + file + " of " +
-                            str(os.stat(file).st_size) + " bytes")
+                            str(fp[0]) + " bytes")
                 server.mkdirs(posixpath.normpath(posixpath.join(remote_data_dir,
                                                                 remote_path)))
                 server.upload(file, posixpath.normpath(posixpath.join(remote_data_dir,
@@ -795,11 +1329,11 @@ or lab technician.""")
                 sql_codes.append(code)
                 mydb.commit()
                 upped.append(file)
-                bs.append(os.stat(file).st_size)
+                bs.append(fp[0])
                 c += 1
             else:
                 logger.info("Known in local DB as uploaded, skipping: " + file)
-                done_before.append((file, checksum, checksumtype))
+                done_before.append((file, checksum, checksumtype, fp))
         # spin1.stop = True
         # spin1.kill = True
     except KeyboardInterrupt or EOFError:
@@ -836,7 +1370,7 @@ or lab technician.""")
         logger.info("Re-uploading " + str(len(done_before)) + " files and " +
                     "updating their local upload counts.")
         try:
-            for file, checksum, checksumtype in done_before:  # second batch, updating runs
+            for file, checksum, checksumtype, fp in done_before:  # second batch, updating runs
                 nothing_much, remote_path = file.split(local_data_prefix)
                 if myos == 'nt':
                     remote_path, filename = ntpath.split(remote_path)
@@ -854,7 +1388,7 @@ or lab technician.""")
                 rel_path = posixpath.normpath(posixpath.join(remote_path, filename))
                 if file in uploaded_before_file:
                     logger.info("File to re-upload: " + file +
-                                " of " + str(os.stat(file).st_size) + " bytes")
+                                " of " + str(fp[0]) + " bytes")
                     server.mkdirs(posixpath.normpath(posixpath.join(remote_data_dir,
                                                                     remote_path)))
                     server.upload(file, posixpath.normpath(posixpath.join(remote_data_dir,
@@ -878,7 +1412,7 @@ or lab technician.""")
                     sql_codes.append(code2)
                     mydb.commit()
                     upped.append(file)
-                    bs2.append(os.stat(file).st_size)
+                    bs2.append(fp[0])
                     c2 += 1
             # spin2.stop = True
             # spin2.kill = True
@@ -916,7 +1450,7 @@ or lab technician.""")
     warnlist = []
     warnlist2 = []
     delete_check = {}
-    for filedel, checksumdel, checksumtypedel in files2delete:
+    for filedel, checksumdel, checksumtypedel, fp in files2delete:
         # If only some files in a WEPV directory are ready for deletion,
         # we don't want to throw away the entire set
         # figure out if it's a set in a wepv dir or not...
@@ -938,12 +1472,14 @@ or lab technician.""")
             normfile = posixpath.normpath(filedel)
         if checksumdel not in trash_checksum:  # it is a new file to trash, saving it
             nu = str(dt.datetime.now().isoformat())
+            # fp: the fingerprint the checksum was made for, checked again before deletion
             cmd = ("INSERT INTO trash VALUES(NULL, " +
-                   "'{0}', NULL, '{1}','{2}', '{3}','{4}','{5}','{6}',{7});".format(nu,
+                   "'{0}', NULL, '{1}','{2}', '{3}','{4}','{5}','{6}',{7}, {8}, {9}, {10});".format(nu,
                                                                                     checksumdel, checksumtypedel,
                                                                                     normfile,
                                                                                     filedel, myos, box_id,
-                                                                                    int(0)))  # V0.24
+                                                                                    int(0), int(fp[0]),
+                                                                                    int(fp[1]), int(fp[2])))  # V0.24
             res, code = mydb.execute(cmd)
             sql_codes.append(code)
             mydb.commit()
@@ -1043,6 +1579,17 @@ or lab technician.""")
     sql_codes.append(code)
     mydb.commit()
     logger.info("Marked " + str(t_count) + " files as deleted in local database.")
+    # last check before anything goes: files must still have the checksum that was
+    # found in the vault, re-hashing only changed files and a random sample
+    failed = sc.verify_trashables(mydb, totrashlist + toretrashlist,
+                                  sample=verify_sample(config))
+    warnlist3 = []
+    for item in failed:
+        warnlist3.append(item)
+        if item in totrashlist:
+            totrashlist.remove(item)
+        if item in toretrashlist:
+            toretrashlist.remove(item)
     # now we run the pre_delete, making it so that entire sets can be deleted
     # we use the delete_check dict first and check if the amount of files given by
     # checksum flow corresponds with the amount of files found within WEPV folders
@@ -1051,7 +1598,8 @@ or lab technician.""")
     incomplete = []
     for dc in double_check:
         osfiles = os.listdir(dc)
-        osfiles[:] = [files for files in osfiles if not files[0] == '.']
+        osfiles[:] = [files for files in osfiles if not files[0] == '.' and
+                      not cs.is_sidecar(os.path.join(dc, files))]
 
         if not len(osfiles) == len(delete_check[dc]):
             for item in delete_check[dc]:
@@ -1072,7 +1620,12 @@ or lab technician.""")
                        " directory that has before been put in the vault with a different" +
                        " amount of files. Not deleting this directory, notify data manager" +
                        " or lab tech.")
-    skipitems = skipitems1 + skipitems2
+    skipitems3 = check_warnlist(warnlist3)
+    for item in skipitems3:
+        logger.warning("File: " + item + " is not deleted because one or more files" +
+                       " from its WEPV directory no longer has the checksum that was" +
+                       " found in the vault.")
+    skipitems = skipitems1 + skipitems2 + skipitems3
     skip_strings = []
     for i in skipitems:
         pad, kikker = os.path.split(i)
@@ -1085,7 +1638,8 @@ or lab technician.""")
             if dont_delete in maybe_delete:
                 actually_delete_list.remove(maybe_delete)
                 kickout = os.listdir(maybe_delete)
-                kickout[:] = [files for files in kickout if not files[0] == '.']
+                kickout[:] = [files for files in kickout if not files[0] == '.' and
+                              not cs.is_sidecar(os.path.join(maybe_delete, files))]
                 amount = len(kickout)
                 exclude_deletion_count += amount
                 # so all files from a set in which one or more files has a different name than
@@ -1112,6 +1666,11 @@ or lab technician.""")
         for w in warnlist2:
             print("This file is not deleted because not all checksums of it's " +
                   "fellow files in its WEPV dir are known: please check -------> " + w)
+    if len(warnlist3) > 0:
+        print("\n!!!!!!!!!!!!!!!!!!!WARNINGS 4 !!!!!!!!!!!!!!!!!!!!!!!!!!")
+        for w in warnlist3:
+            print("This file is not deleted because it changed after it was found " +
+                  "in the vault: please check -------> " + w)
     sql_errors = sum(sql_codes)
     if sql_errors > 0:
         dberror = True
@@ -1119,7 +1678,7 @@ or lab technician.""")
         print("Database errors were encountered, please notify lab tech!")
     else:
         dberror = False
-    if not warnlist and not warnlist2 and not sql_errors > 0:
+    if not warnlist and not warnlist2 and not warnlist3 and not sql_errors > 0:
         print('\n-------------------------------------------')
         print(reward_banner)
         print('Files uploaded: ' + str(l_upped) + '\n' +
@@ -1131,7 +1690,7 @@ or lab technician.""")
         print(hell_banner)
         print("Notify your Lab tech!, specify computer ID and current time.")
     logger.info("Sync run finished.")
-    return upped, totrashlist, toretrashlist, warnlist, warnlist2, dberror
+    return upped, totrashlist, toretrashlist, warnlist, warnlist2, warnlist3, dberror
 
 
 def check_warnlist(warnlist):
@@ -1172,6 +1731,8 @@ def check_warnlist(warnlist):
         otherfiles = os.listdir(dir)
         if otherfiles:
             for otherfile in otherfiles:
+                if cs.is_sidecar(os.path.join(dir, otherfile)):
+                    continue
                 if not os.path.join(dir, otherfile) in warnlist:
                     extra.append(os.path.join(dir, otherfile))
     return warnlist + extra
@@ -1218,6 +1779,7 @@ def pre_delete(files2delete):
                 continue
             elif not wepvcheck_dir and wepvcheck_file:
                 wepvfile.append(thing)
+                wepvfile.extend(cs.sidecar_paths(thing))  # goes with its data file
             elif not wepvcheck_dir and not wepvcheck_file:
                 continue
             else:
@@ -1225,7 +1787,7 @@ def pre_delete(files2delete):
     nice = wepvfile + wepvfolder
     nice.sort()
     u = np.unique(nice)
-    out = list(u)
+    out = [str(i) for i in u]  # plain str: os.listdir() of a numpy str_ gives bytes
     return out
 
 
@@ -1323,6 +1885,9 @@ def main(testing=False, implement_test=True):
         *List of files with warnings of type 1.*  
     warnlist2: list  
         *List of files with warnings of type 2.*  
+    warnlist3: list  
+        *List of files with warnings of type 4 (changed after they were found in  
+        the vault).*  
     err: bool  
         *True if any database related errors occurred during a sync run.*  
         
@@ -1348,36 +1913,73 @@ def main(testing=False, implement_test=True):
 
     if not os.path.isfile(database_filename):
         db.build_db(database_filename)
+    else:
+        db.upgrade_db(database_filename)
+
 
+    # the local files are scanned and hashed from the start: while the credentials
+    # are asked for and while the vault index is downloaded
+    local = queue.Queue()
+    def prepare():
+        try:
+            # a config object of its own, configparser is not safe to share between
+            # threads
+            prepare_config = configparser.RawConfigParser()
+            prepare_config.read(config_filename)
+            # re-verify a slice of reused digests before they are relied upon again
+            budget, rate = scrub_settings(prepare_config)
+            if budget:
+                sc.scrub(db.dbManager(database_filename, debug=DEBUGDB), budget, rate)
+            local.put((scan_local(prepare_config, testing), None))
+        except Exception as e:
+            local.put((None, e))
+    # a daemon, so a failed login quits right away; sqlite rolls back what the
+    # thread had not committed
+    threading.Thread(target=prepare, daemon=True).start()
+    logger.info("Started scanning local files.")
 
     # connect to server
     wbdv = connect(config)
     logger.info("Connected to server using webdav.")
 
     print("Downloading list of checksums from vault ...", end=" ")
-    vault_list, md_vault_list, sha_vault_list = download_hash_list(config,
-                                                                   config_filename, wbdv)
+    vault, verified = download_hash_list(config, config_filename, wbdv)
     print("Done.")
     logger.info("Downloaded list with vault files and checksums.")
+    vi.log_stats(vault.stats())
 
-    md_vault_list = sort_list(md_vault_list)
-    sha_vault_list = sort_list(sha_vault_list)
     print("Comparing to local checksums ...", end=" ")
-    uploadlist, deletelist = comp2localchecksum(config, config_filename,
-                                                md_vault_list, sha_vault_list, testing=testing)
+    scan, error = local.get()
+    if error is not None:
+        raise error
+    uploadlist, deletelist = comp2localchecksum(config, config_filename, vault,
+                                                testing=testing, scan=scan)
     print("Done.")
     logger.info("Checksummed local files and comparing with list.")
+    # deletions are only decided on a recently confirmed index; hashing may have
+    # taken long, so refresh (cheap when unchanged) and classify again from cache
+    reuse_seconds, max_age, incremental = index_cache_settings(config)
+    if dt.datetime.now() - verified > max_age:
+        logger.info("Vault index older than " + str(max_age) + ", refreshing it.")
+        vault, verified = download_hash_list(config, config_filename, wbdv)
+        uploadlist, deletelist = comp2localchecksum(config, config_filename, vault,
+                                                    testing=testing)
+    if dt.datetime.now() - verified > max_age:
+        logger.warning("The vault index could not be refreshed (last confirmed at " +
+                       verified.isoformat() + "), not deleting any files this run.")
+        print("Vault index is out of date, no files are deleted this run.")
+        deletelist = []
 
     (upped, trashlist,
-     retrashlist, warnlist,
-     warnlist2, err) = sync(wbdv, config,
+     retrashlist, warnlist, warnlist2,
+     warnlist3, err) = sync(wbdv, config,
                             uploadlist,
                             deletelist,
                             UPLOAD_DELTA,
                             DELETE_DELTA,
                             testing=testing,
                             implement_test=implement_test)
-    if not warnlist and not warnlist2 and not err:
+    if not warnlist and not warnlist2 and not warnlist3 and not err:
         logger.info("===== Ran main sync script without critical errors/warnings =======")
     else:
         logger.info("===== Ran main sync script, WARNINGS/ERRORS were encountered! =====")
@@ -1385,9 +1987,12 @@ def main(testing=False, implement_test=True):
         if MAIL:
             ppwarnlist1 = '\n'.join(warnlist)
             ppwarnlist2 = '\n'.join(warnlist2)
+            ppwarnlist3 = '\n'.join(warnlist3)
             ppdberr = '\nDatabaser errors too?: ' + str(err)
             mess = ('WARNINGS TYPE 1 (File known under different name):\n\n' + ppwarnlist1 + '\n\n------------\n\n' +
                     'WARNINGS TYPE 2 (Not all fellow checksums in WEPV folder are known):\n\n' + ppwarnlist2 +
+                    '\n\n------------\n\n' +
+                    'WARNINGS TYPE 4 (File changed after it was found in the vault):\n\n' + ppwarnlist3 +
                     '\n\n------------\n\n' + ppdberr + '\n\n' + hell_banner + '\n')
 
             if config.has_option("Datamanagers", "email"):
@@ -1404,4 +2009,4 @@ def main(testing=False, implement_test=True):
             except:
                 print("Mailing error: ", sys.exc_info()[0])
     input("Press Enter to quit.")
-    return upped, trashlist, retrashlist, warnlist, warnlist2, err
+    return upped, trashlist, retrashlist, warnlist, warnlist2, warnlist3, err
@@ -0,0 +1,633 @@
+import os
+import gzip
+import array
+import lzma
+import binascii
+import hashlib
+import logging
+import configparser
+import datetime as dt
+from collections import namedtuple
+import numpy as np
+import pkg_resources  # part of setuptools
+
+from labsync import checksum as cs
+from labsync import extsort as es
+from labsync import setops as so
+
+__version__ = pkg_resources.require("labsync")[0].version
+__email__ = 'j.c.vanelst@uu.nl'
+__authors__ = ['Jacco van Elst']
+__doc__ = """Working with the vault index file as downloaded from YODA.
+
+The index format is described in Yoda_indexfile_format.txt. `parse_index` reads it
+as a stream of `Record` tuples; `read_index` hands every record to any number of
+consumers (membership sets, the binary index builder) in one pass.
+
+The text index is parsed only when it changed: `open_index` converts it to a binary
+index in `INDEX_DIR`, with per hashtype a sorted array of fixed width raw digests and
+a sorted array of the file sizes (.npy files), and a manifest that records which
+text index they were built from. Later runs memory map the arrays and look digests
+up with a binary search. Several text indexes (of several vaults, or the shards of
+one) are merged into one binary index that records the vault of every entry.
+
+When the binary index is rebuilt, the digests added to and removed from the vault
+since the previous build are saved next to it (`BinaryVaultIndex.changed_many`), so
+files classified against the previous index only need a lookup in that difference.
+
+With a memory ceiling (see `open_index`) the index is built with an external sort and
+local digests are compared in a merge-join (`labsync.extsort`), so neither step needs
+the whole index in memory.
+"""
+
+logger = logging.getLogger("Labdata_cleanup.vaultindex")
+
+INDEX_DIR = 'vault_index'
+"""
+Directory for the binary vault index, next to the downloaded text index.
+"""
+
+INDEX_FORMAT = '2'
+"""
+Version of the binary index layout; a manifest with another version is rebuilt.
+"""
+
+COMPRESSED = {'.gz': gzip.open, '.xz': lzma.open}
+"""
+Extensions of compressed index files and the functions that open them.
+"""
+
+def open_text(fname):
+    """
+    Open a (possibly gzip or xz compressed) index file for reading text lines.
+    """
+    opener = COMPRESSED.get(os.path.splitext(fname)[1], open)
+    return opener(fname, 'rt', encoding='ascii', errors='replace', newline=None)
+
+Record = namedtuple('Record', ['hashtype', 'digest', 'size', 'path'])
+"""
+One vault index entry: registered hashtype, raw digest bytes, file size (int) and
+the optional pathname (None when absent).
+"""
+
+def parse_lines(lines, problems=None):
+    """
+    Parse index lines into records, one at a time.
+    
+    Lines starting with '#' and blank lines are skipped. Fields are separated by
+    spaces and/or tabs, line endings may be Linux or Windows; everything after the
+    file size is the pathname, which may itself contain spaces.
+    
+    **Parameters**  
+    ---------------
+    lines: iterable  
+        *Index lines (str).*  
+    problems: dict  
+        *Optional, counts skipped lines: 'malformed' and, per unregistered hashtype,  
+        the hashtype name.*  
+    
+    **Yields**  
+    ----------
+    record: Record  
+    """
+    if problems is None:
+        problems = {}
+    widths = dict((hashtype, spec.constructor().digest_size)
+                  for hashtype, spec in cs.HASHTYPES.items())
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        fields = line.split(None, 3)
+        if not fields:
+            continue
+        if fields[0] not in widths:
+            problems[fields[0]] = problems.get(fields[0], 0) + 1
+            continue
+        try:
+            digest = cs.HASHTYPES[fields[0]].decode(fields[1])
+            size = int(fields[2])
+        except (IndexError, ValueError, binascii.Error):
+            digest = None
+        if digest is None or len(digest) != widths[fields[0]] or size < 0:
+            problems['malformed'] = problems.get('malformed', 0) + 1
+            continue
+        path = fields[3].rstrip() if len(fields) == 4 else None
+        yield Record(fields[0], digest, size, path or None)
+
+def parse_index(fname, problems=None):
+    """
+    Parse a (possibly compressed) index file into records, see `parse_lines`.
+    """
+    with open_text(fname) as f:
+        for record in parse_lines(f, problems):
+            yield record
+
+def log_problems(problems):
+    """
+    Write the lines skipped by `parse_lines` to the log.
+    """
+    for name, count in problems.items():
+        if name == 'malformed':
+            logger.warning("Skipped " + str(count) + " malformed vault index entries.")
+        else:
+            logger.warning("Ignoring " + str(count) + " vault index entries of " +
+                           "unregistered hashtype " + name + ".")
+
+def read_index(fname, consumers):
+    """
+    Parse an index file once, handing every record to all consumers.
+    
+    **Parameters**  
+    ---------------
+    fname: str  
+        *The text index, see `open_text`.*  
+    consumers: list  
+        *Objects with an `add_record(record)` method, e.g. an `IndexBuilder`.*  
+    
+    **Returns**  
+    ------------
+    problems: dict  
+        *Skipped lines, see `parse_lines`; they are logged as well.*  
+    """
+    problems = {}
+    adds = [consumer.add_record for consumer in consumers]
+    for record in parse_index(fname, problems):
+        for add in adds:
+            add(record)
+    log_problems(problems)
+    return problems
+
+def log_stats(stats):
+    """
+    Write index statistics to the log.
+    """
+    if not stats:
+        logger.info("The vault index has no entries.")
+    for hashtype, s in sorted(stats.items()):
+        logger.info("Vault index: " + str(s['count']) + " " + hashtype + " entries, " +
+                    "file sizes " + str(s['min_size']) + " to " + str(s['max_size']) +
+                    " bytes.")
+
+class BinaryVaultIndex(object):
+    """
+    A binary vault index as written by `build_index`, memory mapped.
+
+    Looks up many local digests at once; the arrays stay in the page cache instead
+    of on the Python heap. With `memory_bytes` set, `contains_many` reads the digest
+    arrays sequentially in a merge-join instead of searching them at random.
+
+    `source` identifies the text index(es) it was built from, `previous` those of the
+    build before, if the difference with it is known. `vaults` names the vaults the
+    entries came from, see `vaults_many`.
+    """
+    def __init__(self, directory=INDEX_DIR, memory_bytes=None):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.manifest = read_manifest(directory)
+        self.source = self.manifest.get('Index', 'source_sha256')
+        self.previous = self.manifest.get('Diff', 'previous', fallback=None)
+        self.vaults = self.manifest.get('Index', 'vaults').split()
+        self.digests = {}
+        self.origins = {}
+        self.sizes = {}
+        self.added = {}
+        self.removed = {}
+        for hashtype in self.manifest.get('Index', 'hashtypes').split():
+            self.digests[hashtype] = _load(os.path.join(directory, hashtype + '.npy'))
+            self.origins[hashtype] = _load(os.path.join(directory,
+                                                        hashtype + '_vaults.npy'))
+            self.sizes[hashtype] = _load(os.path.join(directory, hashtype + '_sizes.npy'))
+            if self.previous:
+                self.added[hashtype] = _load(os.path.join(directory, hashtype + '_added.npy'))
+                self.removed[hashtype] = _load(os.path.join(directory,
+                                                            hashtype + '_removed.npy'))
+
+    def contains_many(self, hashtype, encoded):
+        """
+        Which hash strings, encoded like in the index file (None allowed), are in the
+        vault, as a boolean array.
+
+        All digestsare looked up with one vectorized binary search, or with a
+        merge-join within `memory_bytes`.
+        """
+        digests = self.digests.get(hashtype)
+        if digests is None or not len(digests):
+            return np.zeros(len(encoded), dtype=bool)
+        local, valid = so.to_array(encoded, cs.HASHTYPES[hashtype].decode,
+                                   digests.dtype.itemsize)
+        if self.memory_bytes:
+            return es.member_external(local, digests, self.memory_bytes, valid)
+        return so.member(local, digests, valid)
+
+    def vaults_many(self, hashtype, encoded):
+        """
+        The vault each hash string was found in, None where it is not in the index.
+
+        A digest found in several vaults is reported for the first of `vaults`.
+        """
+        digests = self.digests.get(hashtype)
+        if digests is None or not len(digests):
+            return [None] * len(encoded)
+        local, valid = so.to_array(encoded, cs.HASHTYPES[hashtype].decode,
+                                   digests.dtype.itemsize)
+        found, pos = so.locate(local, digests, valid)
+        origins = self.origins[hashtype]
+        return [self.vaults[origins[p]] if f else None for f, p in zip(found, pos)]
+
+    def has_sizes(self, hashtype, sizes):
+        """
+        Boolean array: which of `sizes` occur among the entries of `hashtype`.
+        """
+        if hashtype not in self.sizes:
+            return np.zeros(len(sizes), dtype=bool)
+        return so.member(np.asarray(sizes, dtype='<i8'), self.sizes[hashtype])
+
+    def changed_many(self, hashtype, encoded):
+        """
+        Boolean array: which hash strings were added to or removed from the vault
+        since the `previous` index. Only meaningful when `previous` is set.
+        """
+        if hashtype not in self.added:
+            return np.zeros(len(encoded), dtype=bool)
+        added, removed = self.added[hashtype], self.removed[hashtype]
+        local, valid = so.to_array(encoded, cs.HASHTYPES[hashtype].decode,
+                                   added.dtype.itemsize)
+        return so.member(local, added, valid) | so.member(local, removed, valid)
+
+    def stats(self):
+        """
+        Count and file size range per hashtype, as `log_stats` writes them.
+        """
+        out = {}
+        for hashtype, digests in self.digests.items():
+            sizes = self.sizes[hashtype]
+            if len(digests):
+                out[hashtype] = {'count': len(digests), 'min_size': int(sizes[0]),
+                                 'max_size': int(sizes[-1])}
+        return out
+
+    def __len__(self):
+        return sum(len(digests) for digests in self.digests.values())
+
+def _load(fname):
+    """
+    Memory map a .npy file; empty arrays cannot be mapped and are read instead.
+    """
+    try:
+        return np.load(fname, mmap_mode='r')
+    except ValueError:
+        return np.load(fname)
+
+def _save(fname, array):
+    """
+    Write a .npy file through a temporary file, so readers never see half of it.
+    """
+    with open(fname + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(fname + '.tmp', fname)
+
+def _save_blocks(outputs, count, blocks):
+    """
+    `_save` for records that arrive in blocks, e.g. from `labsync.extsort.SortedRuns`.
+
+    **Parameters**  
+    ---------------
+    outputs: list  
+        *(file name, field, dtype) per .npy file to write; field None for the whole  
+        record.*  
+    count: int  
+        *Total number of records.*  
+    blocks: iterable  
+        *Arrays of records.*  
+    """
+    outs = [(np.lib.format.open_memmap(fname + '.tmp', mode='w+', dtype=dtype,
+                                       shape=(count,)), field)
+            for fname, field, dtype in outputs]
+    start = 0
+    for block in blocks:
+        for out, field in outs:
+            out[start:start + len(block)] = block[field] if field else block
+        start += len(block)
+    for out, field in outs:
+        out.flush()
+    outs = out = None  # unmapped before the files are moved
+    for fname, field, dtype in outputs:
+        os.replace(fname + '.tmp', fname)
+
+def _unique_blocks(blocks):
+    """
+    Sorted blocks without the values already in earlier blocks.
+    """
+    last = None
+    for block in blocks:
+        block = np.unique(block)
+        if last is not None and len(block) and block[0] == last:
+            block = block[1:]
+        if len(block):
+            last = block[-1]
+            yield block
+
+def _diff(old, new, memory_bytes=None):
+    """
+    Digests added to and removed from the vault, given the sorted old and new arrays.
+    """
+    if memory_bytes:
+        found_new = es.member_sorted(new, old, memory_bytes)
+        found_old = es.member_sorted(old, new, memory_bytes)
+    else:
+        found_new = so.member(new, old)
+        found_old = so.member(old, new)
+    return np.asarray(new[~found_new]), np.asarray(old[~found_old])
+
+def file_sha256(fname):
+    """
+    SHA256 of a file, identifying the text index a binary index was built from.
+    """
+    return cs.chunk_multi(fname, ('SHA256',))['SHA256']
+
+def vault_name(fname):
+    """
+    Name of the vault a text index belongs to, from its file name: index files are
+    named after their vault, e.g. 'grp-vault-youth.txt'.
+    """
+    name = os.path.basename(fname)
+    for ext in list(COMPRESSED) + ['.txt']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+def sources_of(textfile):
+    """
+    The text indexes as a list of (vault, file name) tuples.
+
+    **Parameters**  
+    ---------------
+    textfile: str or list  
+        *One text index, its vault named after the file (see `vault_name`), or a list  
+        of (vault, file name) tuples: several vaults, and/or one vault split into  
+        shards.*  
+    """
+    if isinstance(textfile, str):
+        return [(vault_name(textfile), textfile)]
+    return list(textfile)
+
+def read_manifest(directory=INDEX_DIR):
+    """
+    The manifest of a binary index, an empty configparser object if there is none.
+    """
+    manifest = configparser.ConfigParser()
+    manifest.read(os.path.join(directory, 'manifest.ini'))
+    return manifest
+
+def _vaults(sources):
+    """
+    Vault names in order of first appearance; their position is the vault id.
+    """
+    vaults = []
+    for vault, fname in sources:
+        if vault not in vaults:
+            vaults.append(vault)
+    return vaults
+
+def is_current(textfile, directory=INDEX_DIR, unchanged=False):
+    """
+    Check if the binary index in `directory` was built from `textfile` as it is now.
+    
+    **Parameters**  
+    ---------------
+    textfile: str or list  
+        *The downloaded text index(es), see `sources_of`.*  
+    directory: str  
+        *The binary index directory.*  
+    unchanged: bool  
+        *True if the text indexes are known to be the ones downloaded before (e.g.  
+        the server answered 304 Not Modified), which spares hashing them.*  
+    
+    **Returns**  
+    ------------
+    bool  
+        *False when a text index, the vaults, the registered hashtypes or the format  
+        changed.*  
+    """
+    sources = sources_of(textfile)
+    manifest = read_manifest(directory)
+    if not manifest.has_section('Index') or not manifest.has_section('Sources'):
+        return False
+    index = manifest['Index']
+    if (index.get('format') != INDEX_FORMAT or
+            index.get('hashtypes', '').split() != list(cs.HASHTYPES) or
+            index.get('vaults', '').split() != _vaults(sources) or
+            len(manifest['Sources']) != len(sources)):
+        return False
+    for vault, fname in sources:
+        recorded = manifest.get('Sources', os.path.basename(fname), fallback='').split()
+        if len(recorded) != 3 or recorded[:2] != [vault, str(os.path.getsize(fname))]:
+            return False
+        if not unchanged and recorded[2] != file_sha256(fname):
+            return False
+    return True
+
+class IndexBuilder(object):
+    """
+    Record consumer that collects the digests and sizes of a binary index.
+
+    The raw digests of each hashtype are packed into one growing byte buffer, which
+    numpy views as a fixed width array when writing, so no Python object is kept
+    per entry. Next to it a buffer holds the id of the vault each entry came from,
+    `vault` at the time it was added, and one the file sizes. With `memory_bytes`
+    set, a full buffer is sorted and spilled to a temporary run file, and the runs
+    are merged (the sizes de-duplicated) while writing.
+    """
+    def __init__(self, memory_bytes=None):
+        self.memory_bytes = memory_bytes
+        self.vault = 0
+        self.raws = dict((hashtype, bytearray()) for hashtype in cs.HASHTYPES)
+        self.origins = dict((hashtype, bytearray()) for hashtype in cs.HASHTYPES)
+        self.sizes = dict((hashtype, array.array('q')) for hashtype in cs.HASHTYPES)
+        self.dtypes = dict((hashtype, np.dtype([('key', 'S%d' % spec.constructor().digest_size),
+                                                 ('vault', 'u1')]))
+                           for hashtype, spec in cs.HASHTYPES.items())
+        self.runs = {}
+        self.size_runs = {}
+        self.limit = None
+        if memory_bytes:
+            # digests and sizes of every hashtype share the ceiling
+            self.limit = max(1, memory_bytes // (2 * len(cs.HASHTYPES)))
+            self.runs = dict((hashtype, es.SortedRuns(dtype, self.limit, order='key'))
+                             for hashtype, dtype in self.dtypes.items())
+            self.size_runs = dict((hashtype, es.SortedRuns('<i8', self.limit))
+                                  for hashtype in cs.HASHTYPES)
+
+    def add_record(self, record):
+        self.raws[record.hashtype] += record.digest
+        self.origins[record.hashtype].append(self.vault)
+        self.sizes[record.hashtype].append(record.size)
+        if self.limit and len(self.raws[record.hashtype]) >= self.limit:
+            self._spill(record.hashtype)
+        if self.limit and 8 * len(self.sizes[record.hashtype]) >= self.limit:
+            self.size_runs[record.hashtype].add(self._sizes(record.hashtype))
+
+    def _records(self, hashtype):
+        dtype = self.dtypes[hashtype]
+        records = np.empty(len(self.origins[hashtype]), dtype=dtype)
+        records['key'] = np.frombuffer(self.raws[hashtype], dtype=dtype['key'])
+        records['vault'] = np.frombuffer(self.origins[hashtype], dtype='u1')
+        self.raws[hashtype] = bytearray()
+        self.origins[hashtype] = bytearray()
+        return records
+
+    def _spill(self, hashtype):
+        self.runs[hashtype].add(self._records(hashtype))
+
+    def _sizes(self, hashtype):
+        sizes = np.unique(np.frombuffer(self.sizes[hashtype], dtype=np.int64))
+        self.sizes[hashtype] = array.array('q')
+        return sizes.astype('<i8')
+
+    def write(self, textfile, directory=INDEX_DIR):
+        """
+        Write the .npy files and the manifest for text index(es) `textfile`.
+
+        Per hashtype '<hashtype>.npy' holds the sorted digests, '<hashtype>_vaults.npy'
+        the vault id of each and '<hashtype>_sizes.npy' the sorted file sizes. If the
+        directory holds a binary index of the same layout, the digests added and
+        removed since are written as '<hashtype>_added.npy' and
+        '<hashtype>_removed.npy', and the manifest gets a [Diff] section.
+
+        **Returns**  
+        ------------
+        counts: dict  
+            *Number of entries per hashtype.*  
+        """
+        sources = sources_of(textfile)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = configparser.ConfigParser()
+        old = read_manifest(directory)
+        comparable = (old.has_section('Index') and
+                      old.get('Index', 'format', fallback=None) == INDEX_FORMAT and
+                      old.get('Index', 'hashtypes', fallback='').split() == list(cs.HASHTYPES))
+        # drop the manifest first: a build that breaks off must not look current
+        if os.path.exists(os.path.join(directory, 'manifest.ini')):
+            os.remove(os.path.join(directory, 'manifest.ini'))
+        counts = {}
+        diff = {}
+        for hashtype, dtype in self.dtypes.items():
+            fname = os.path.join(directory, hashtype + '.npy')
+            origins = os.path.join(directory, hashtype + '_vaults.npy')
+            # the new arrays are written aside, to diff the digests with the old ones
+            if self.runs and self.runs[hashtype].runs:
+                runs = self.runs[hashtype]
+                self._spill(hashtype)
+                try:
+                    _save_blocks([(fname + '.new', 'key', dtype['key']),
+                                  (origins + '.new', 'vault', dtype['vault'])],
+                                 runs.count, runs.blocks())
+                finally:
+                    runs.close()
+                counts[hashtype] = runs.count
+            else:
+                # sorted on digest, then vault: a lookup finds the first vault
+                records = np.sort(self._records(hashtype), order='key')
+                _save(fname + '.new', np.ascontiguousarray(records['key']))
+                _save(origins + '.new', np.ascontiguousarray(records['vault']))
+                counts[hashtype] = len(records)
+                del records
+            self.raws[hashtype] = None
+            self.origins[hashtype] = None
+            if comparable and os.path.exists(fname):
+                added, removed = _diff(_load(fname), _load(fname + '.new'), self.memory_bytes)
+                _save(os.path.join(directory, hashtype + '_added.npy'), added)
+                _save(os.path.join(directory, hashtype + '_removed.npy'), removed)
+                diff[hashtype + '_added'] = str(len(added))
+                diff[hashtype + '_removed'] = str(len(removed))
+            os.replace(fname + '.new', fname)
+            os.replace(origins + '.new', origins)
+            sizes = os.path.join(directory, hashtype + '_sizes.npy')
+            if self.size_runs and self.size_runs[hashtype].runs:
+                runs = self.size_runs[hashtype]
+                runs.add(self._sizes(hashtype))
+                try:
+                    # the merged runs are read twice, to count and to write them
+                    count = sum(len(block) for block in _unique_blocks(runs.blocks()))
+                    _save_blocks([(sizes, None, np.dtype('<i8'))], count,
+                                 _unique_blocks(runs.blocks()))
+                finally:
+                    runs.close()
+            else:
+                _save(sizes, self._sizes(hashtype))
+            self.sizes[hashtype] = None
+        recorded = dict((os.path.basename(fname),
+                         ' '.join([vault, str(os.path.getsize(fname)), file_sha256(fname)]))
+                        for vault, fname in sources)
+        # one identity for the combination of text indexes, see BinaryVaultIndex.source
+        identity = hashlib.sha256(''.join(name + ' ' + recorded[name] + '\n'
+                                          for name in sorted(recorded)).encode())
+        manifest['Index'] = {'format': INDEX_FORMAT,
+                             'hashtypes': ' '.join(cs.HASHTYPES),
+                             'vaults': ' '.join(_vaults(sources)),
+                             'source_sha256': identity.hexdigest(),
+                             'built': str(dt.datetime.now().isoformat())}
+        manifest['Sources'] = recorded
+        manifest['Counts'] = dict((hashtype, str(count)) for hashtype, count in counts.items())
+        if comparable and len(diff) == 2 * len(counts):
+            diff['previous'] = old.get('Index', 'source_sha256')
+            manifest['Diff'] = diff
+        with open(os.path.join(directory, 'manifest.ini'), 'w') as f:
+            manifest.write(f)
+        return counts
+
+def build_index(textfile, directory=INDEX_DIR, memory_bytes=None):
+    """
+    Parse text index(es) into one binary index.
+    
+    **Parameters**  
+    ---------------
+    textfile: str or list  
+        *The downloaded text index, or several, see `sources_of`; gzip or xz  
+        compressed when they end in '.gz' or '.xz'.*  
+    directory: str  
+        *Where to write the .npy files and the manifest.*  
+    memory_bytes: int  
+        *Memory ceiling for sorting the digests, None to sort them in memory.*  
+    
+    **Returns**  
+    ------------
+    counts: dict  
+        *Number of entries per hashtype.*  
+    """
+    sources = sources_of(textfile)
+    vaults = _vaults(sources)
+    if len(vaults) > 256:
+        raise ValueError("At most 256 vaults can be combined in one index.")
+    builder = IndexBuilder(memory_bytes)
+    for vault, fname in sources:
+        builder.vault = vaults.index(vault)
+        read_index(fname, [builder])
+    return builder.write(sources, directory)
+
+def open_index(textfile, directory=INDEX_DIR, unchanged=False, memory_bytes=None):
+    """
+    Open the binary index for text index(es), (re)building it only when needed.
+    
+    **Parameters**  
+    ---------------
+    textfile: str or list  
+        *The downloaded text index(es), see `sources_of`.*  
+    directory: str  
+        *The binary index directory.*  
+    unchanged: bool  
+        *See `is_current`.*  
+    memory_bytes: int  
+        *Memory ceiling for building and comparing, None for no limit.*  
+    
+    **Returns**  
+    ------------
+    index: BinaryVaultIndex  
+    """
+    if is_current(textfile, directory, unchanged):
+        logger.info("Vault index did not change, using the binary index in " + directory)
+    else:
+        counts = build_index(textfile, directory, memory_bytes)
+        logger.info("Built binary vault index in " + directory + ": " + str(counts))
+    return BinaryVaultIndex(directory, memory_bytes)
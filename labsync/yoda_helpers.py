@@ -88,30 +88,29 @@ def yodasim_indexfile(to_md5_list=None, to_sha_list=None, outpath=None):
     save: list  
         A list (and/or a file) in YODA indexfile format.  
     """
-    skip1 = False
     save = []
+    # every file is read once, also when it is in both lists
+    to_md5_list = to_md5_list or []
+    to_sha_list = to_sha_list or []
+    algos = {}
     for f in to_md5_list:
-        try:
-            md5hash = cs.chunk_md5(f, blocksize=4096)
-        except OSError as e:
-            skip1 = True
-        if not skip1:
-            size1 = str(os.stat(f).st_size)
-            line1 = 'md5 ' + md5hash + ' ' + size1 + ' ' + f + ' \n'
-            save.append(line1)
-    #second list, not very pythonic, no
-    skip2 = False
+        algos.setdefault(f, []).append('MD5')
     for f in to_sha_list:
+        algos.setdefault(f, []).append('SHA256')
+    hashes = {}
+    for f, algoIDs in algos.items():
         try:
-            shahash = cs.chunk_sha256(f, blocksize=4096)
+            hashes[f] = (cs.chunk_multi(f, algoIDs), str(os.stat(f).st_size))
         except OSError as e:
-            skip2 = True
-        if not skip2:
-            size2 = str(os.stat(f).st_size)
-            to_fix_sha = str(shahash)
-            fix_sha = to_fix_sha[2:-1]
-            line2 = 'sha2 ' + fix_sha + ' ' + size2 + ' ' + f + ' \n'
-            save.append(line2)
+            continue
+    for f in to_md5_list:
+        if f in hashes:
+            digests, size = hashes[f]
+            save.append('md5 ' + digests['MD5'] + ' ' + size + ' ' + f + ' \n')
+    for f in to_sha_list:
+        if f in hashes:
+            digests, size = hashes[f]
+            save.append('sha2 ' + digests['SHA256'] + ' ' + size + ' ' + f + ' \n')
     if outpath:
         with open(outpath, "w") as checkfile:
             checkfile.writelines(save)